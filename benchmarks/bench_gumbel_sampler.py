@@ -0,0 +1,99 @@
+"""
+Compare the legacy arange-based Gumbel id recovery with `src.sampling.GumbelSampler`.
+
+Each implementation runs in its own process so that peak memory is not shared between them.
+
+    python benchmarks/bench_gumbel_sampler.py --batch_size 32 --seq_len 128 --vocab_size 30522
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def legacy_sample(logits):
+    import torch
+    import torch.nn.functional as F
+
+    batch_size, seq_len, vocab_size = logits.shape
+    mask = F.gumbel_softmax(logits, tau=1, hard=True, dim=-1)
+    idx = torch.arange(0, vocab_size, dtype=torch.float32, device=logits.device, requires_grad=True).reshape(1, 1, -1).repeat(batch_size, seq_len, 1)
+    return torch.sum(mask * idx, dim=2)
+
+
+def run(impl, args, queue):
+    import torch
+
+    from src.sampling import GumbelSampler
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    logits = torch.randn(args.batch_size, args.seq_len, args.vocab_size, device=device, requires_grad=True)
+    sampler = GumbelSampler(tau=1.0)
+
+    def step():
+        if impl == 'arange':
+            ids = legacy_sample(logits)
+        else:
+            _, ids = sampler(logits)
+        ids.sum().backward()
+        logits.grad = None
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base
+    elapsed = time.perf_counter() - start
+
+    queue.put({
+        'impl': impl,
+        'steps_per_sec': args.steps / elapsed,
+        # on CPU this is the growth of the process high-water mark over the timed steps
+        'peak_mem_mb': max(peak, 0) / 2 ** 20,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Gumbel token sampling")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--seq_len", type=int, default=128)
+    parser.add_argument("--vocab_size", type=int, default=30522)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--output", type=str, default=None, help="Optional json file to write the results to.")
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    results = []
+    for impl in ['arange', 'index']:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run, args=(impl, args, queue))
+        proc.start()
+        results.append(queue.get())
+        proc.join()
+
+    for r in results:
+        print(f"{r['impl']:>8}: {r['steps_per_sec']:.2f} steps/s, peak {r['peak_mem_mb']:.1f} MB")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
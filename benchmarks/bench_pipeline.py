@@ -0,0 +1,218 @@
+"""
+Time the CILDA stages and the GLUE collator on tiny randomly initialized BERT models, without any download.
+
+The models, the tokenizer and an sst2-shaped dataset (`--glue_data_dir` files) are built in `--workdir`. Every stage
+runs in its own process, so peak RSS is per stage; the later stages load the teacher and generator saved by the
+earlier ones. Steps/s and tokens/s come from the stage's `ThroughputMeter`.
+
+    python benchmarks/bench_pipeline.py --max_train_steps 20 --output bench.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STAGES = ['teacher', 'generator', 'generate', 'student']
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+
+def build_models(args):
+    from transformers import BertConfig, BertForMaskedLM, BertForSequenceClassification, BertTokenizerFast
+
+    words = [f"w{i}" for i in range(args.vocab_size - len(SPECIAL_TOKENS))]
+    vocab_path = os.path.join(args.workdir, 'vocab.txt')
+    with open(vocab_path, 'w') as f:
+        f.write("\n".join(SPECIAL_TOKENS + words))
+    tokenizer = BertTokenizerFast(vocab_path)
+
+    config = BertConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        intermediate_size=4 * args.hidden_size,
+        max_position_embeddings=max(args.max_length, 128),
+        num_labels=2,
+    )
+    for name, model_class in [('generator', BertForMaskedLM), ('teacher', BertForSequenceClassification), ('student', BertForSequenceClassification)]:
+        model_path = os.path.join(args.workdir, 'models', name)
+        model_class(config).save_pretrained(model_path)
+        tokenizer.save_pretrained(model_path)
+    return words
+
+
+def build_glue_data(args, words):
+    rng = random.Random(0)
+    glue_dir = os.path.join(args.workdir, 'glue')
+    os.makedirs(glue_dir, exist_ok=True)
+    sizes = {'train': args.num_train_examples, 'validation': args.num_eval_examples, 'test': args.num_eval_examples}
+    for split, num_examples in sizes.items():
+        with open(os.path.join(glue_dir, f"{split}.tsv"), 'w') as f:
+            f.write("sentence\tlabel\tidx\n")
+            for i in range(num_examples):
+                # lengths vary so that padding and length grouping matter
+                sentence = " ".join(rng.choices(words, k=rng.randint(4, args.max_length - 2)))
+                label = rng.randint(0, 1) if split != 'test' else -1
+                f.write(f"{sentence}\t{label}\t{i}\n")
+
+
+def cilda_args(args, stage):
+    from src.Args import parse_args
+
+    models = os.path.join(args.workdir, 'models')
+    output_dir = os.path.join(args.workdir, 'output')
+    argv = [
+        "--task_name", "sst2",
+        "--glue_data_dir", os.path.join(args.workdir, 'glue'),
+        "--output_dir", output_dir,
+        "--teacher_model_name", os.path.join(models, 'teacher'),
+        "--generator_model_name", os.path.join(models, 'generator'),
+        "--student_model_name", os.path.join(models, 'student'),
+        "--max_length", str(args.max_length),
+        "--batch_size", str(args.batch_size),
+        "--select_k_per_class", str(args.select_k_per_class),
+        "--max_train_steps", str(args.max_train_steps),
+        "--precision", args.precision,
+        # no eval inside the timed loops
+        "--eval_every_step", str(10 ** 9),
+    ]
+    flags = {
+        'teacher': ["--do_train_teacher"],
+        'generator': ["--do_train_generator", "--teacher_checkpoint_path", os.path.join(output_dir, 'teacher')],
+        'generate': ["--generate_data", "--generator_checkpoint_path", os.path.join(output_dir, 'generator')],
+        'student': ["--do_train_student", "--teacher_checkpoint_path", os.path.join(output_dir, 'teacher')],
+        'collator': [],
+    }
+    sys.argv = ["main.py"] + argv + flags[stage] + args.extra_args
+    return parse_args()
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(stage, args, queue):
+    import torch
+
+    from src import CILDA
+
+    torch.set_num_threads(args.num_threads)
+    # synthetic data is written relative to the working directory
+    os.chdir(args.workdir)
+    cil_model = CILDA(cilda_args(args, stage))
+    if stage == 'teacher':
+        cil_model.train_teacher(train_epochs=1)
+    elif stage == 'generator':
+        cil_model.train_generator(train_epochs=1)
+    elif stage == 'generate':
+        cil_model.generate_synthetic_data(syn_data_output_path=os.path.join('data', cil_model.args.syn_data_path))
+    else:
+        cil_model.train_student(train_epochs=1)
+    queue.put(dict(cil_model.throughput[stage], peak_rss_mb=peak_rss_mb()))
+
+
+def run_collator(args, queue):
+    from src.dataset import GLUE_Dataset
+    from src.instrumentation import ThroughputMeter
+    from transformers import AutoTokenizer
+
+    os.chdir(args.workdir)
+    cil_args = cilda_args(args, 'collator')
+    tokenizer = AutoTokenizer.from_pretrained(cil_args.teacher_model_name)
+    dataloader = GLUE_Dataset(cil_args, tokenizer).get_final_ds(task='sst2', split='train', batch_size=args.batch_size)
+    dataset, collate_fn = dataloader.dataset, dataloader.collate_fn
+    features = [dataset[i] for i in range(len(dataset))]
+
+    meter = ThroughputMeter('collator')
+    for step in range(args.collator_steps):
+        start = step * args.batch_size % len(features)
+        batch = collate_fn(features[start:start + args.batch_size])
+        meter.update(batch['attention_mask'])
+    queue.put(dict(meter.summary(), peak_rss_mb=peak_rss_mb()))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def torch_threads_default():
+    # the same threads for every run, so results are comparable across machines with more cores
+    return min(4, os.cpu_count() or 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CILDA stages on tiny offline models")
+    parser.add_argument("--workdir", type=str, default=None, help="Where to build the models and data, a temporary directory by default.")
+    parser.add_argument("--stages", type=str, nargs="+", default=STAGES + ['collator'], choices=STAGES + ['collator'])
+    parser.add_argument("--vocab_size", type=int, default=1000)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_hidden_layers", type=int, default=2)
+    parser.add_argument("--num_attention_heads", type=int, default=2)
+    parser.add_argument("--max_length", type=int, default=64)
+    parser.add_argument("--num_train_examples", type=int, default=512)
+    parser.add_argument("--num_eval_examples", type=int, default=64)
+    parser.add_argument("--select_k_per_class", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_train_steps", type=int, default=20)
+    parser.add_argument("--collator_steps", type=int, default=200)
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16"])
+    parser.add_argument("--num_threads", type=int, default=torch_threads_default())
+    parser.add_argument("--output", type=str, default=None, help="Optional json file to write the results to.")
+    parser.add_argument("extra_args", nargs=argparse.REMAINDER, help="Passed on to the CILDA args, after `--`.")
+    args = parser.parse_args()
+    args.extra_args = [arg for arg in args.extra_args if arg != '--']
+
+    tmpdir = None
+    if args.workdir is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix='bench_pipeline_')
+        args.workdir = tmpdir.name
+    os.makedirs(os.path.join(args.workdir, 'data'), exist_ok=True)
+    build_glue_data(args, build_models(args))
+
+    ctx = mp.get_context('spawn')
+    results = []
+    start = time.perf_counter()
+    # in pipeline order, every stage reads what the previous ones wrote
+    for stage in [stage for stage in STAGES + ['collator'] if stage in args.stages]:
+        queue = ctx.Queue()
+        if stage == 'collator':
+            proc = ctx.Process(target=run_collator, args=(args, queue))
+        else:
+            proc = ctx.Process(target=run_stage, args=(stage, args, queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            raise RuntimeError(f"{stage} benchmark exited with code {proc.exitcode}")
+        results.append(queue.get())
+
+    for r in results:
+        print(
+            f"{r['stage']:>10}: {r['steps_per_second']:.2f} steps/s, {r['tokens_per_second']:.0f} tokens/s, "
+            f"peak RSS {r['peak_rss_mb']:.0f} MB"
+        )
+    if args.output is not None:
+        config = {k: v for k, v in vars(args).items() if k not in ['workdir', 'output']}
+        with open(args.output, 'w') as f:
+            json.dump(
+                {'commit': git_commit(), 'config': config, 'seconds': time.perf_counter() - start, 'results': results},
+                f, indent=2,
+            )
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,7 @@ import transformers
 # from src.model import CILDA
 from src.Args import parse_args
 from src import CILDA
+from src.pipeline import Pipeline
 
 logger = get_logger(__name__)
 
@@ -39,22 +40,33 @@ def main():
     transformers.utils.logging.set_verbosity_info()
     args = parse_args()
     cil_model = CILDA(args)
+    logger.info(cil_model.accelerator.state, main_process_only=False)
+    # runs the requested stages, with `--skip_up_to_date_stages` only those whose inputs changed
+    pipeline = Pipeline(args, cil_model.accelerator)
+
     # First do training on the teacher using full dataset
     
     if args.do_train_teacher:
-        cil_model.train_teacher(train_epochs=args.teacher_num_train_epochs)
+        pipeline.run('teacher', lambda: cil_model.train_teacher(train_epochs=args.teacher_num_train_epochs))
+        cil_model.finish_stage('teacher')
     
     # train the generator using few-shot dataset
     if args.do_train_generator:
-        cil_model.train_generator(train_epochs=args.generator_num_train_epochs) 
+        pipeline.run('generator', lambda: cil_model.train_generator(train_epochs=args.generator_num_train_epochs))
+        cil_model.finish_stage('generator')
 
     # generate synthetic data
     if args.generate_data:
-        cil_model.generate_synthetic_data(syn_data_output_path='data/syn_data.json')
+        pipeline.run(
+            'generate',
+            lambda: cil_model.generate_synthetic_data(syn_data_output_path=os.path.join('data', args.syn_data_path)),
+        )
+        cil_model.finish_stage('generate')
     
     # train student using generate_synthetic and few-shot data 
     if args.do_train_student:
-        cil_model.train_student(train_epochs=args.student_num_train_epochs)
+        pipeline.run('student', lambda: cil_model.train_student(train_epochs=args.student_num_train_epochs))
+        cil_model.finish_stage('student')
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
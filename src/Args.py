@@ -32,6 +32,15 @@ def parse_args():
         help="The name of the glue task to train on.",
         choices=list(task_to_keys.keys()),
     )
+    parser.add_argument(
+        "--glue_data_dir",
+        type=str,
+        default=None,
+        help=(
+            "Read the GLUE splits from local train/validation(dev)/test .tsv, .csv, .jsonl or .parquet files in this"
+            " directory instead of downloading them."
+        ),
+    )
     parser.add_argument(
         "--max_length",
         type=int,
@@ -46,12 +55,82 @@ def parse_args():
         action="store_true",
         help="If passed, pad all samples to `max_length`. Otherwise, dynamic padding is used.",
     )
+    parser.add_argument(
+        "--preprocessing_num_workers",
+        type=int,
+        default=None,
+        help="The number of processes to use for the preprocessing.",
+    )
+    parser.add_argument(
+        "--overwrite_cache",
+        action="store_true",
+        help="Overwrite the cached tokenized datasets under `output_dir/tokenized_cache`.",
+    )
+    parser.add_argument(
+        "--return_special_tokens_mask",
+        action="store_true",
+        help="Store the special tokens mask at tokenization time so the MLM collator does not recompute it per batch.",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Group examples of similar length into the same batch to reduce padding.",
+    )
 
     parser.add_argument(
         "--syn_data_path",
         type=str,
         default="syn_data.json",
     )
+    parser.add_argument(
+        "--syn_data_format",
+        type=str,
+        default="ids",
+        choices=["ids", "text"],
+        help=(
+            "Store the synthetic data as token ids (an Arrow dataset next to `syn_data_path`, keeping the exact"
+            " generator tokens) or as decoded text in `syn_data_path`, re-tokenized for the student."
+        ),
+    )
+    parser.add_argument(
+        "--save_syn_text",
+        action="store_true",
+        help="Also write the decoded text json when `--syn_data_format ids` is used.",
+    )
+    parser.add_argument(
+        "--syn_source",
+        type=str,
+        default="few-shot",
+        choices=["few-shot", "full"],
+        help="Training split the synthetic data is generated from.",
+    )
+    parser.add_argument(
+        "--syn_generation_rounds",
+        type=int,
+        default=1,
+        help="Number of passes over the source split, each pass draws new masks and samples for every example.",
+    )
+    parser.add_argument(
+        "--num_samples_per_input",
+        type=int,
+        default=1,
+        help="Number of synthetic variants drawn from the same generator logits for every input.",
+    )
+    parser.add_argument(
+        "--resample_mask_probability",
+        type=float,
+        default=0.0,
+        help=(
+            "If > 0, every variant only replaces a fresh random subset of the masked positions, each one with this"
+            " probability, instead of all of them."
+        ),
+    )
+    parser.add_argument(
+        "--syn_shard_size",
+        type=int,
+        default=10000,
+        help="Number of synthetic examples kept in memory before they are flushed to a shard on disk.",
+    )
     
     
     # Training Setting
@@ -196,6 +275,101 @@ def parse_args():
         help="do evaluation every steps",
     )
 
+    parser.add_argument(
+        "--async_eval",
+        action="store_true",
+        help="Evaluate the teacher during training in a background process on a snapshot of its weights.",
+    )
+    parser.add_argument(
+        "--async_eval_threads",
+        type=int,
+        default=1,
+        help="Intra-op threads of the background eval process.",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="Run the forwards of all stages under bf16 autocast, weights and optimizer states stay in fp32.",
+    )
+    parser.add_argument(
+        "--step_timing",
+        action="store_true",
+        help="Time every step of a stage by phase (data, h2d, forwards, backward, optimizer, eval). Synchronizes on cuda.",
+    )
+    parser.add_argument(
+        "--log_timing_every",
+        type=int,
+        default=50,
+        help="With --step_timing, log the mean phase times, tokens/s and padding ratio every n steps, 0 for the total only.",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("FIRST", "LAST"),
+        help="Record steps FIRST to LAST (from 0, inclusive) of every stage with torch.profiler.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="Where to write the --profile_steps chrome traces, defaults to output_dir/profile.",
+    )
+    parser.add_argument(
+        "--teacher_dtype",
+        type=str,
+        default="fp32",
+        choices=["fp32", "fp16", "bf16"],
+        help="Precision the frozen teacher is held in during the generator and student stages.",
+    )
+    parser.add_argument(
+        "--quantize_teacher",
+        action="store_true",
+        help="Quantize the linear layers of the frozen teacher to int8 (cpu only) for the generator and student stages.",
+    )
+    parser.add_argument(
+        "--quantize_teacher_max_metric_drop",
+        type=float,
+        default=0.01,
+        help="Use the int8 teacher only if its eval metric is at most this much below the float32 teacher's.",
+    )
+    parser.add_argument(
+        "--cache_teacher_logits",
+        action="store_true",
+        help="Compute the teacher logits of the synthetic dataset once and reuse them across student epochs and runs.",
+    )
+    parser.add_argument(
+        "--fuse_student_forward",
+        action="store_true",
+        help="Run the real and the synthetic inputs through the teacher and the student as one concatenated batch.",
+    )
+    parser.add_argument(
+        "--log_samples_every",
+        type=int,
+        default=0,
+        help="Log one real/synthetic pair every n generator and generation batches, 0 disables it.",
+    )
+    parser.add_argument(
+        "--log_metrics_every",
+        type=int,
+        default=50,
+        help="Log the generator and student losses every n optimizer steps, 0 disables it.",
+    )
+    parser.add_argument(
+        "--log_max_records_per_second",
+        type=float,
+        default=10.0,
+        help="Rate limit of the sample and metric logs, records over it are dropped. 0 for no limit.",
+    )
+
+    parser.add_argument(
+        "--skip_up_to_date_stages",
+        action="store_true",
+        help="Skip requested stages whose inputs match output_dir/pipeline_manifest.json and whose output is unchanged.",
+    )
     parser.add_argument(
         "--teacher_checkpoint_path",
         type=str,
@@ -213,7 +387,10 @@ def parse_args():
         "--resume_from_checkpoint",
         type=str,
         default=None,
-        help="If the training should continue from a checkpoint folder.",
+        help=(
+            "If the training should continue from a checkpoint folder, e.g. output_dir/checkpoints/teacher/step_100. "
+            "'latest' resumes every stage from its newest checkpoint."
+        ),
     )
     parser.add_argument(
         "--with_tracking",
@@ -0,0 +1,129 @@
+import copy
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from accelerate.logging import get_logger
+from torch.utils.data import DataLoader
+
+from src.metrics import GlueMetric
+
+logger = get_logger(__name__)
+
+
+def _eval_worker(model, dataset, collate_fn, batch_size, task_name, precision, num_threads, requests, results):
+    torch.set_num_threads(num_threads)
+    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+    metric = GlueMetric(task_name, num_examples=len(dataset))
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        metric.reset()
+        with torch.inference_mode(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+            for batch in dataloader:
+                logits = model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask']).logits
+                metric.add_batch(logits=logits, references=batch['clf_labels'])
+        results.put((request, metric.compute()))
+
+
+class AsyncEvaluator:
+    """
+    Evaluates snapshots of a model in a background process while training continues.
+
+    The worker holds a cpu copy of the model whose weights live in shared memory. `submit` copies the current
+    weights into it and hands the worker the step, the worker runs the eval set and posts the metric back, which
+    `poll` logs. A `submit` while the previous eval is still running keeps a cpu copy of the weights as pending,
+    replacing an older pending one, and `poll` hands it to the worker once it is free. `close` evaluates the final
+    weights and waits for everything submitted.
+
+    Args:
+        model (`nn.Module`): the (unwrapped) model being trained.
+        dataset (`datasets.Dataset`): the eval set, sent to the worker once together with `collate_fn`.
+        collate_fn (`Callable`): the collator of the eval dataloader.
+        batch_size (`int`): eval batch size of the worker.
+        task_name (`str`): the GLUE task of the metric.
+        precision (`str`): `fp32` or `bf16`, as `--precision`.
+        num_threads (`int`): intra-op threads of the worker, so it does not compete with training for every core.
+        name (`str`): prefix of the logged results.
+    """
+
+    def __init__(self, model, dataset, collate_fn, batch_size, task_name, precision='fp32', num_threads=1, name='eval'):
+        self.name = name
+        self.snapshot = copy.deepcopy(model).cpu().float().eval()
+        self.snapshot.requires_grad_(False)
+        self.snapshot.share_memory()
+
+        context = mp.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.busy = False
+        # weights and info of the latest submit that came while the worker was busy
+        self.pending = None
+        self.last_info = None
+        self.history = []
+        self.worker = context.Process(
+            target=_eval_worker,
+            args=(
+                self.snapshot, dataset, collate_fn, batch_size,
+                task_name, precision, num_threads, self.requests, self.results,
+            ),
+            daemon=True,
+        )
+        self.worker.start()
+
+    @torch.no_grad()
+    def submit(self, model, **info):
+        """
+        Snapshot `model` and evaluate it in the background, `info` (e.g. step, epoch) is logged with the result.
+        Returns whether the eval started right away rather than being left pending.
+        """
+        self.poll()
+        self.last_info = info
+        if self.busy:
+            if self.pending is not None:
+                logger.warning(f"{self.name} of {self.pending[1]} is replaced by the newer {info}")
+            self.pending = ([tensor.detach().cpu().clone() for tensor in model.state_dict().values()], info)
+            return False
+        self._start(model.state_dict().values(), info)
+        return True
+
+    def _start(self, tensors, info):
+        for snapshot_tensor, tensor in zip(self.snapshot.state_dict().values(), tensors):
+            snapshot_tensor.copy_(tensor)
+        self.busy = True
+        self.requests.put(info)
+
+    def poll(self, block=False):
+        """Log the result of a finished eval, waiting for it with `block`."""
+        if not self.busy:
+            return None
+        while True:
+            try:
+                info, eval_metric = self.results.get(timeout=1.0 if block else None, block=block)
+                break
+            except queue.Empty:
+                if not block:
+                    return None
+                if not self.worker.is_alive():
+                    raise RuntimeError(f"{self.name} worker exited with code {self.worker.exitcode}")
+        self.busy = False
+        self.history.append((info, eval_metric))
+        logger.info(f"{self.name} {info}: {eval_metric}")
+        if self.pending is not None:
+            tensors, pending_info = self.pending
+            self.pending = None
+            self._start(tensors, pending_info)
+        return eval_metric
+
+    def close(self, model=None, **info):
+        """
+        Evaluate the final weights of `model` (unless `info` is the last one submitted), wait for all the submitted
+        evals and stop the worker.
+        """
+        if model is not None and info != self.last_info:
+            self.submit(model, **info)
+        while self.busy:
+            self.poll(block=True)
+        self.requests.put(None)
+        self.worker.join()
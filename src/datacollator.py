@@ -154,6 +154,57 @@ class DataCollatorForLanguageModelingAndClassification(DataCollatorMixin):
     
     
 
+@dataclass
+class DataCollatorForSyntheticPairs:
+    """
+    Data collator for the student's synthetic dataset. Pads the real (`input_ids`, `attention_mask`) and the
+    synthetic (`syn_input_ids`, `syn_attention_mask`) inputs of a batch independently, each to its own longest
+    sequence. A missing mask column is built from the sequence lengths. Any other key is stacked as is.
+
+    Args:
+        tokenizer ([`PreTrainedTokenizer`] or [`PreTrainedTokenizerFast`]):
+            The tokenizer used for encoding the data.
+        pad_to_multiple_of (`int`, *optional*):
+            If set will pad the sequence to a multiple of the provided value.
+        pad_pairs_to_same_length (`bool`, *optional*, defaults to `False`):
+            Pad the real and the synthetic inputs to the same length, so that they can be concatenated along the
+            batch dimension.
+    """
+
+    tokenizer: PreTrainedTokenizerBase
+    pad_to_multiple_of: Optional[int] = None
+    pad_pairs_to_same_length: bool = False
+    pair_keys: Tuple[Tuple[str, str], ...] = (("input_ids", "attention_mask"), ("syn_input_ids", "syn_attention_mask"))
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
+        import torch
+
+        batch = {}
+        padding, max_length = True, None
+        if self.pad_pairs_to_same_length:
+            padding = "max_length"
+            max_length = max(len(f[ids_key]) for f in features for ids_key, _ in self.pair_keys)
+        for ids_key, mask_key in self.pair_keys:
+            padded = self.tokenizer.pad(
+                [
+                    {"input_ids": f[ids_key], "attention_mask": f[mask_key]} if mask_key in f else {"input_ids": f[ids_key]}
+                    for f in features
+                ],
+                padding=padding,
+                max_length=max_length,
+                return_tensors="pt",
+                pad_to_multiple_of=self.pad_to_multiple_of,
+            )
+            batch[ids_key] = padded["input_ids"]
+            batch[mask_key] = padded["attention_mask"]
+
+        pair_columns = {key for pair in self.pair_keys for key in pair}
+        for key in features[0]:
+            if key not in pair_columns:
+                batch[key] = torch.stack([torch.as_tensor(f[key]) for f in features], dim=0)
+        return batch
+
+
 def _torch_collate_batch(examples, tokenizer, pad_to_multiple_of: Optional[int] = None):
     """Collate `examples` into a batch, using the information in `tokenizer` for padding if necessary."""
     import torch
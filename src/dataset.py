@@ -1,13 +1,20 @@
+import hashlib
+import json
+import os
+import shutil
+
 import pandas as pd
 import numpy as np
+import torch
 
 from torch.utils.data import Dataset, DataLoader
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
 import datasets
 from transformers import (
     DataCollatorWithPadding,
     DataCollatorForLanguageModeling,
 )
+from transformers.trainer_pt_utils import LengthGroupedSampler
 
 from src.datacollator import DataCollatorForLanguageModelingAndClassification
 
@@ -29,57 +36,215 @@ class GLUE_Dataset:
         }
         
         self.label_key = 'label'
+        self._dataset = None
+        self._source = None
+
+    @property
+    def dataset(self):
+        # only loaded on a tokenized cache miss
+        if self._dataset is None:
+            if self.args.glue_data_dir is not None:
+                self._dataset = load_local_glue(self.args.glue_data_dir)
+            else:
+                self._dataset = load_dataset('glue', self.args.task_name)
+            print(self._dataset)
+        return self._dataset
         
-        self.dataset = load_dataset('glue', args.task_name)
-        print(self.dataset)
-        
+    @property
+    def source(self):
+        # local files are keyed on their content, so edited files are tokenized again
+        if self._source is None:
+            if self.args.glue_data_dir is not None:
+                self._source = local_glue_fingerprint(self.args.glue_data_dir)
+            else:
+                self._source = 'glue'
+        return self._source
+
     def select_subset_ds(self, ds, k=200, seed=0):
     
         label_key = self.label_key
         N = len(ds[label_key])
         idx_total = np.array([], dtype='int64')
+        # seeded before sampling so that (k, seed) always picks the same subset, which the tokenized cache relies on
+        rng = np.random.RandomState(seed)
 
-        for l in set(ds[label_key]):
+        for l in sorted(set(ds[label_key])):
             idx = np.where(np.array(ds[label_key]) == l)[0]
             idx_total = np.concatenate([idx_total, # we cannot take more samples than there are available
-            np.random.choice(idx, min(k, idx.shape[0]), replace=False)])
+            rng.choice(idx, min(k, idx.shape[0]), replace=False)])
 
-        np.random.seed(seed)
-        np.random.shuffle(idx_total)
+        rng.shuffle(idx_total)
         return ds.select(idx_total)
     
     def preprocess_fn(self, examples, task):
         tokenizer = self.tokenizer
         # Preprocess dataset
         sentence1_key, sentence2_key = self.task_to_keys[task]
-        padding = "max_length"
+        # without `--pad_to_max_length` the ids are stored unpadded and the collator pads each batch
+        padding = "max_length" if self.args.pad_to_max_length else False
         text = (
             (examples[sentence1_key]) if sentence2_key is None else (examples[sentence1_key], examples[sentence2_key])
         )
         
-        inputs = tokenizer(text, padding='max_length', max_length=self.max_length, truncation=True)
+        # with the mask stored, the MLM collator skips its per-row `get_special_tokens_mask` fallback
+        inputs = tokenizer(
+            text, padding=padding, max_length=self.max_length, truncation=True,
+            return_special_tokens_mask=self.args.return_special_tokens_mask,
+        )
         
         inputs['labels'] = examples['label']
         return inputs
 
     def get_final_ds(self, task, split, batch_size, k=-1, seed=0):
         # model_type : ['gen' , 'clf']
-        dataset = self.dataset[split]
-        if k!=-1:
-            dataset = self.select_subset_ds(dataset, k)
-        else:
-            dataset = dataset.shuffle(seed=seed)
-        
-        processed_dataset = dataset.map(
-            lambda x: self.preprocess_fn(x, task),
-            batched=True,
+        cache_dir = tokenized_cache_dir(
+            self.args, self.tokenizer, name=f"{task}-{split}",
+            task=task, split=split, k=k, seed=seed, source=self.source,
+            special_tokens_mask=self.args.return_special_tokens_mask,
         )
+        if cache_dir is not None and os.path.isdir(cache_dir) and not self.args.overwrite_cache:
+            processed_dataset = load_from_disk(cache_dir)
+        else:
+            dataset = self.dataset[split]
+            if k!=-1:
+                dataset = self.select_subset_ds(dataset, k, seed=seed)
+            else:
+                dataset = dataset.shuffle(seed=seed)
+
+            processed_dataset = dataset.map(
+                lambda x: self.preprocess_fn(x, task),
+                batched=True,
+                num_proc=self.args.preprocessing_num_workers,
+            )
+            if cache_dir is not None:
+                save_to_cache(processed_dataset, cache_dir)
         
         data_collator = DataCollatorForLanguageModelingAndClassification(
             tokenizer=self.tokenizer, mlm_probability=self.args.mlm_probability, pad_to_multiple_of=8
         )
 
-        processed_dataset.set_format(type='torch', columns=['input_ids', 'attention_mask', 'labels'])
+        columns = ['input_ids', 'attention_mask', 'labels']
+        if self.args.return_special_tokens_mask:
+            columns.append('special_tokens_mask')
+        processed_dataset.set_format(type='torch', columns=columns)
         
-        dataloader = DataLoader(processed_dataset, collate_fn=data_collator, batch_size=batch_size)
-        return dataloader
\ No newline at end of file
+        dataloader = build_dataloader(self.args, processed_dataset, collate_fn=data_collator, batch_size=batch_size, seed=seed)
+        return dataloader
+
+
+# `load_dataset` builder and extra kwargs for each supported local file type
+LOCAL_FILE_BUILDERS = {
+    '.tsv': ('csv', {'delimiter': '\t', 'quoting': 3}),
+    '.csv': ('csv', {}),
+    '.jsonl': ('json', {}),
+    '.json': ('json', {}),
+    '.parquet': ('parquet', {}),
+}
+LOCAL_SPLIT_NAMES = {
+    'train': ['train'],
+    'validation': ['validation', 'dev'],
+    'test': ['test'],
+}
+
+
+def load_local_glue(data_dir):
+    """
+    Load GLUE splits from `data_dir` instead of the hub. Each split is a `{split}.{tsv,csv,jsonl,json,parquet}`
+    file (`dev` is accepted for `validation`) with the columns of the hub `glue` dataset, i.e. the task's sentence
+    keys and an integer `label`. The files are converted to Arrow once and memory-mapped from the datasets cache.
+    """
+    data_files, builder = local_glue_files(data_dir)
+    return load_dataset(builder[0], data_files=data_files, **builder[1])
+
+
+def local_glue_fingerprint(data_dir):
+    """Content hash of the split files `load_local_glue` reads from `data_dir`."""
+    data_files, _ = local_glue_files(data_dir)
+    hasher = hashlib.sha1()
+    for split, path in sorted(data_files.items()):
+        hasher.update(f"{split}:{os.path.basename(path)}:{file_fingerprint(path)}".encode())
+    return hasher.hexdigest()
+
+
+def local_glue_files(data_dir):
+    """The file of every split in `data_dir` and the `LOCAL_FILE_BUILDERS` entry of their file type."""
+    data_files = {}
+    builder = None
+    for split, names in LOCAL_SPLIT_NAMES.items():
+        paths = [os.path.join(data_dir, name + ext) for name in names for ext in LOCAL_FILE_BUILDERS]
+        paths = [path for path in paths if os.path.isfile(path)]
+        if not paths:
+            continue
+        data_files[split] = paths[0]
+        split_builder = LOCAL_FILE_BUILDERS[os.path.splitext(paths[0])[1]]
+        if builder is not None and split_builder != builder:
+            raise ValueError(f"All GLUE splits in {data_dir} should have the same file type.")
+        builder = split_builder
+    if not data_files:
+        raise FileNotFoundError(f"No train/validation/test files found in {data_dir}")
+    return data_files, builder
+
+
+def tokenized_cache_dir(args, tokenizer, name, **key):
+    """
+    Directory under `output_dir/tokenized_cache` for a tokenized dataset, keyed by `key` together with the
+    tokenizer identity and the tokenization settings. `None` when there is no `output_dir`.
+    """
+    if args.output_dir is None:
+        return None
+    vocab = sorted(tokenizer.get_vocab().items())
+    key.update(
+        tokenizer=tokenizer.name_or_path,
+        tokenizer_class=type(tokenizer).__name__,
+        vocab=hashlib.sha1(json.dumps(vocab).encode()).hexdigest(),
+        max_length=args.max_length,
+        pad_to_max_length=args.pad_to_max_length,
+    )
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(args.output_dir, 'tokenized_cache', f"{name}-{digest}")
+
+
+def file_fingerprint(path):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def save_to_cache(dataset, cache_dir):
+    # write next to the final location and rename, so an interrupted run never leaves a half written cache
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    dataset.save_to_disk(tmp_dir)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def build_dataloader(args, dataset, collate_fn, batch_size, seed=0):
+    """DataLoader over `dataset`, batching examples of similar length together with `--group_by_length`."""
+    sampler = None
+    if args.group_by_length:
+        lengths = [len(input_ids) for input_ids in dataset.with_format(None)['input_ids']]
+        sampler = EpochSeededLengthGroupedSampler(batch_size, lengths=lengths, seed=seed)
+    return DataLoader(dataset, collate_fn=collate_fn, batch_size=batch_size, sampler=sampler)
+
+
+class EpochSeededLengthGroupedSampler(LengthGroupedSampler):
+    """
+    `LengthGroupedSampler` whose order only depends on `seed` and the epoch passed to `set_epoch`, not on how many
+    epochs the generator already drew. A run resumed from a checkpoint then sees the same order as the interrupted
+    one, so skipping the consumed batches skips the right examples.
+    """
+
+    def __init__(self, batch_size, lengths, seed=0):
+        super().__init__(batch_size, lengths=lengths, generator=torch.Generator())
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        self.generator.manual_seed(self.seed + self.epoch)
+        return super().__iter__()
\ No newline at end of file
@@ -0,0 +1,65 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+TORCH_DTYPES = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+class FrozenModel(nn.Module):
+    """
+    Wraps a model that is only run forward, like the teacher in the distillation stages.
+
+    The parameters are frozen and every forward runs under `torch.inference_mode`, so no autograd graph or saved
+    activations are kept for it. The returned logits are copied out of inference mode as float32, so they can be
+    used in losses that backprop into other models.
+
+    Args:
+        model (`nn.Module`): the model to freeze, converted in place.
+        dtype (`torch.dtype`, *optional*): cast the weights to this dtype, e.g. `torch.bfloat16`.
+        quantize (`bool`, *optional*, defaults to `False`):
+            Hold a copy with the `nn.Linear` layers dynamically quantized to int8 instead, see `quantize_dynamic_int8`.
+            It always runs in float32, also under `--precision bf16` autocast.
+    """
+
+    def __init__(self, model, dtype=None, quantize=False):
+        super().__init__()
+        model.eval()
+        model.requires_grad_(False)
+        self.quantized = quantize
+        if quantize:
+            model = quantize_dynamic_int8(model)
+        elif dtype is not None:
+            model.to(dtype)
+        self.model = model
+
+    @property
+    def config(self):
+        return self.model.config
+
+    def train(self, mode=True):
+        # always stays in eval mode
+        return super().train(False)
+
+    def forward(self, **inputs):
+        # the int8 kernels only take float32 activations, so a quantized model runs outside of any bf16 autocast
+        no_autocast = contextlib.nullcontext()
+        if self.quantized:
+            no_autocast = torch.autocast(device_type='cpu', enabled=False)
+            inputs = {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v for k, v in inputs.items()}
+        with torch.inference_mode(), no_autocast:
+            outputs = self.model(**inputs)
+        outputs.logits = outputs.logits.float().clone()
+        return outputs
+
+
+def quantize_dynamic_int8(model):
+    """
+    Copy of a float32 `model` with int8 weights in its `nn.Linear` layers, activations are quantized on the fly.
+    Only runs on CPU.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
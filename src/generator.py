@@ -0,0 +1,55 @@
+import torch
+
+# Modules applied after the encoder by `AutoModelForMaskedLM` heads, in order.
+MLM_HEAD_MODULES = [
+    ('cls',),  # bert
+    ('lm_head',),  # roberta, xlm-roberta, deberta-v2 style heads
+    ('generator_predictions', 'generator_lm_head'),  # electra
+    ('vocab_transform', 'activation', 'vocab_layer_norm', 'vocab_projector'),  # distilbert
+]
+
+
+def get_mlm_head(generator):
+    for names in MLM_HEAD_MODULES:
+        if all(hasattr(generator, name) for name in names):
+            return [getattr(generator, name) for name in names]
+    return None
+
+
+def masked_lm_logits(generator, input_ids, attention_mask, masked_indices):
+    """
+    Run the masked LM generator and project to the vocabulary only at `masked_indices`.
+
+    Args:
+        generator (`AutoModelForMaskedLM`): the MLM generator.
+        input_ids, attention_mask (`torch.LongTensor` of shape `(batch_size, seq_len)`): the (masked) inputs.
+        masked_indices (`torch.BoolTensor` of shape `(batch_size, seq_len)`): positions to predict,
+            i.e. `lm_labels != -100`.
+
+    Returns:
+        `torch.FloatTensor` of shape `(num_masked, vocab_size)`, rows in `masked_indices.nonzero()` order.
+    """
+    head = get_mlm_head(generator)
+    if head is None:
+        # unknown head layout, fall back to the full forward
+        logits = generator(input_ids=input_ids, attention_mask=attention_mask).logits
+        return logits[masked_indices]
+
+    hidden_states = generator.base_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+    hidden_states = hidden_states[masked_indices]
+    for module in head:
+        hidden_states = module(hidden_states)
+    return hidden_states
+
+
+def merge_masked_tokens(input_ids, lm_labels, sampled_ids):
+    """
+    Build the real and the synthetic inputs of a whole batch from the collator's masked inputs.
+
+    Masked positions get their original token back in `input_ids` and the generator's sample in
+    `synthetic_input_ids`, everything else is shared. `sampled_ids` is ordered like `masked_indices.nonzero()`.
+    """
+    masked_indices = lm_labels != -100
+    input_ids = torch.where(masked_indices, lm_labels, input_ids)
+    synthetic_input_ids = input_ids.masked_scatter(masked_indices, sampled_ids)
+    return input_ids, synthetic_input_ids
@@ -0,0 +1,237 @@
+import contextlib
+import os
+import time
+from collections import defaultdict
+
+import torch
+from accelerate.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class ThroughputMeter:
+    """
+    Counts the batches, examples and non-padding tokens a stage processes and the wall time it took.
+
+    Args:
+        stage (`str`): name of the stage, used in the summary.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.steps = 0
+        self.examples = 0
+        self.tokens = 0
+        # token slots including padding, for the padding ratio
+        self.padded_tokens = 0
+        self.start_time = time.perf_counter()
+
+    def update(self, *attention_masks):
+        """Count one step over the inputs with the given attention masks, e.g. the real and the synthetic ones."""
+        self.steps += 1
+        for attention_mask in attention_masks:
+            self.examples += attention_mask.shape[0]
+            self.tokens += int(attention_mask.sum())
+            self.padded_tokens += attention_mask.numel()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'stage': self.stage,
+            'steps': self.steps,
+            'examples': self.examples,
+            'tokens': self.tokens,
+            'padding_ratio': padding_ratio(self.tokens, self.padded_tokens),
+            'seconds': elapsed,
+            'steps_per_second': self.steps / elapsed if elapsed > 0 else 0.0,
+            'examples_per_second': self.examples / elapsed if elapsed > 0 else 0.0,
+            'tokens_per_second': self.tokens / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def padding_ratio(tokens, padded_tokens):
+    return 1 - tokens / padded_tokens if padded_tokens else 0.0
+
+
+class StepTimer:
+    """
+    Breaks the wall time of every step of a stage down by phase: data loading, host to device copy (the loaders are
+    prepared without device placement, the loop copies the batch), the forward of each model, backward, optimizer
+    step, eval, ... The time of a step outside of any phase is reported as `other`,
+    mostly python overhead; a phase outside of any step (after `end_step` or the last batch of an epoch) only counts
+    in the totals and the next logged summary. Every `log_every` steps the mean time per phase over those steps is
+    logged together with the tokens/s and padding ratio counted by `meter`.
+
+    With `profile_steps` the steps from `profile_steps[0]` to `profile_steps[1]` (counted from 0, inclusive) are
+    recorded with `torch.profiler`, the phases showing up as labelled ranges, and exported as a chrome trace to
+    `profile_path`.
+
+    On cuda every phase synchronizes the device, so that kernels are counted in the phase that launched them. That
+    slows the stage down, which is why the timing is off unless `enabled`.
+
+    Args:
+        meter (`ThroughputMeter`): the meter of the stage, updated by the training loop.
+        device (`torch.device`): the device the stage runs on.
+        enabled (`bool`, *optional*, defaults to `False`): time the phases.
+        log_every (`int`, *optional*, defaults to 0): steps between logged summaries, 0 to only log the total.
+        profile_steps (`Tuple[int, int]`, *optional*): first and last step to profile.
+        profile_path (`str`, *optional*): where to write the trace of `profile_steps`.
+    """
+
+    def __init__(self, meter, device, enabled=False, log_every=0, profile_steps=None, profile_path=None):
+        self.meter = meter
+        self.stage = meter.stage
+        self.device = device
+        self.enabled = enabled
+        self.log_every = log_every
+        self.profile_steps = profile_steps
+        self.profile_path = profile_path
+        self.profiler = None
+
+        # index of the next step
+        self.step = 0
+        self.step_start = None
+        self.current = defaultdict(float)
+        self.window = defaultdict(float)
+        self.totals = defaultdict(float)
+        self.window_steps = 0
+        self.total_steps = 0
+        self._start_window()
+
+    @property
+    def active(self):
+        return self.enabled or self.profiler is not None
+
+    def phase(self, name):
+        """Context timing the code it wraps as phase `name` of the current step."""
+        if not self.active:
+            return contextlib.nullcontext()
+        return self._timed_phase(name)
+
+    @contextlib.contextmanager
+    def _timed_phase(self, name):
+        self._synchronize()
+        start = time.perf_counter()
+        label = torch.profiler.record_function(f"{self.stage}/{name}") if self.profiler is not None else contextlib.nullcontext()
+        with label:
+            yield
+            self._synchronize()
+        elapsed = time.perf_counter() - start
+        if self.step_start is None:
+            # between steps, e.g. an eval after the epoch: counted in the totals and the window but in no step
+            self.window[name] += elapsed
+            self.totals[name] += elapsed
+        else:
+            self.current[name] += elapsed
+
+    def _synchronize(self):
+        if self.enabled and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def batches(self, iterable):
+        """Yields the batches of `iterable`, every one starts a step whose loading is timed as the `data` phase."""
+        iterator = iter(iterable)
+        while True:
+            self._begin_step()
+            with self.phase('data'):
+                item = next(iterator, None)
+            if item is None:
+                # the iterator is exhausted, no step after all
+                self.step_start = None
+                self.current.clear()
+                return
+            yield item
+
+    def _begin_step(self):
+        self._end_step()
+        if self.profile_steps is not None:
+            first, last = self.profile_steps
+            # a step is only counted once its batch is loaded, so the same index can begin twice at an epoch end
+            if self.profiler is None and self.step == first:
+                self._start_profiler()
+            elif self.profiler is not None and self.step > last:
+                self._stop_profiler()
+        self.step_start = time.perf_counter()
+
+    def end_step(self):
+        """End the current step early, so that what follows is not counted in it."""
+        self._end_step()
+
+    def _end_step(self):
+        if self.step_start is None:
+            return
+        elapsed = time.perf_counter() - self.step_start
+        self.step_start = None
+        if self.active:
+            self.current['other'] += max(elapsed - sum(self.current.values()), 0.0)
+            for name, seconds in self.current.items():
+                self.window[name] += seconds
+                self.totals[name] += seconds
+            self.current.clear()
+        self.step += 1
+        self.window_steps += 1
+        self.total_steps += 1
+        if self.enabled and self.log_every and self.window_steps >= self.log_every:
+            self._log_window()
+
+    def _start_window(self):
+        self.window.clear()
+        self.window_steps = 0
+        self.window_start = time.perf_counter()
+        self.window_tokens = (self.meter.tokens, self.meter.padded_tokens)
+
+    def _log_window(self):
+        elapsed = time.perf_counter() - self.window_start
+        tokens = self.meter.tokens - self.window_tokens[0]
+        padded_tokens = self.meter.padded_tokens - self.window_tokens[1]
+        logger.info(
+            f"{self.stage} steps {self.step - self.window_steps}-{self.step - 1}: "
+            f"{format_phases(self.window, self.window_steps)}, {tokens / elapsed:.1f} tokens/s, "
+            f"padding {padding_ratio(tokens, padded_tokens):.1%}"
+        )
+        self._start_window()
+
+    def _start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.profiler.__enter__()
+        logger.info(f"profiling {self.stage} steps {self.profile_steps[0]}-{self.profile_steps[1]}")
+
+    def _stop_profiler(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(os.path.dirname(self.profile_path) or '.', exist_ok=True)
+        self.profiler.export_chrome_trace(self.profile_path)
+        logger.info(f"wrote the {self.stage} profiler trace to {self.profile_path}", main_process_only=False)
+        self.profiler = None
+
+    def finish(self):
+        """End the last step and profiler window, call once the stage loop is over."""
+        self._end_step()
+        self._stop_profiler()
+
+    def summary(self):
+        """Seconds and share of the step time of every phase, over all the steps."""
+        total = sum(self.totals.values())
+        return {
+            name: {
+                'seconds': seconds,
+                'ms_per_step': 1000 * seconds / self.total_steps,
+                'share': seconds / total if total > 0 else 0.0,
+            }
+            for name, seconds in sorted(self.totals.items(), key=lambda item: -item[1])
+        }
+
+
+def format_phases(seconds_by_phase, steps):
+    """e.g. `"84.2 ms/step (teacher_forward 61%, backward 20%, data 9%, ...)"`"""
+    total = sum(seconds_by_phase.values())
+    if steps == 0 or total == 0:
+        return "0.0 ms/step"
+    phases = ", ".join(
+        f"{name} {seconds / total:.0%}" for name, seconds in sorted(seconds_by_phase.items(), key=lambda item: -item[1])
+    )
+    return f"{1000 * total / steps:.1f} ms/step ({phases})"
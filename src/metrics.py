@@ -0,0 +1,120 @@
+import torch
+
+
+class GlueMetric:
+    """
+    In-process replacement for `evaluate.load('glue', task_name)`, returning the same keys.
+
+    Logits and references are written into preallocated tensors by `add_batch` and every score is computed with
+    tensor ops in `compute`, so evaluating does not load a module or build Python lists.
+
+    Args:
+        task_name (`str`): the GLUE task, decides which scores are returned.
+        num_examples (`int`, *optional*): expected number of examples, used to size the buffers up front.
+    """
+
+    def __init__(self, task_name, num_examples=0):
+        self.task_name = task_name
+        self.is_regression = task_name == 'stsb'
+        self.reset(num_examples)
+
+    def reset(self, num_examples=None):
+        if num_examples is not None:
+            self.capacity = num_examples
+        self.logits = None
+        self.references = None
+        self.size = 0
+
+    def _reserve(self, logits, references, n):
+        if self.logits is None:
+            capacity = max(self.capacity, n)
+            self.logits = logits.new_empty((capacity,) + tuple(logits.shape[1:]))
+            self.references = references.new_empty(capacity)
+        elif self.size + n > self.logits.shape[0]:
+            capacity = max(2 * self.logits.shape[0], self.size + n)
+            logits_buffer = self.logits.new_empty((capacity,) + tuple(self.logits.shape[1:]))
+            references_buffer = self.references.new_empty(capacity)
+            logits_buffer[:self.size] = self.logits[:self.size]
+            references_buffer[:self.size] = self.references[:self.size]
+            self.logits, self.references = logits_buffer, references_buffer
+
+    def add_batch(self, logits, references):
+        logits = logits.detach().float()
+        references = references.detach().reshape(-1)
+        n = logits.shape[0]
+        self._reserve(logits, references, n)
+        self.logits[self.size:self.size + n] = logits
+        self.references[self.size:self.size + n] = references
+        self.size += n
+
+    def predictions(self):
+        logits = self.logits[:self.size]
+        if self.is_regression:
+            return logits.reshape(-1)
+        return logits.argmax(dim=-1)
+
+    def compute(self):
+        predictions = self.predictions()
+        references = self.references[:self.size]
+        if self.task_name == 'cola':
+            return {'matthews_correlation': matthews_correlation(predictions, references)}
+        elif self.task_name == 'stsb':
+            return {
+                'pearson': pearson_correlation(predictions, references.float()),
+                'spearmanr': spearman_correlation(predictions, references.float()),
+            }
+        elif self.task_name in ['mrpc', 'qqp']:
+            return {'accuracy': accuracy(predictions, references), 'f1': f1_score(predictions, references)}
+        return {'accuracy': accuracy(predictions, references)}
+
+
+def accuracy(predictions, references):
+    return (predictions == references).double().mean().item()
+
+
+def f1_score(predictions, references):
+    # binary F1 of the positive class, like sklearn's default
+    tp = ((predictions == 1) & (references == 1)).sum().item()
+    fp = ((predictions == 1) & (references != 1)).sum().item()
+    fn = ((predictions != 1) & (references == 1)).sum().item()
+    if tp == 0:
+        return 0.0
+    return 2 * tp / (2 * tp + fp + fn)
+
+
+def matthews_correlation(predictions, references):
+    # multiclass MCC from the confusion matrix, as in sklearn.metrics.matthews_corrcoef
+    num_classes = int(max(predictions.max().item(), references.max().item())) + 1
+    confusion = torch.bincount(references * num_classes + predictions, minlength=num_classes ** 2)
+    confusion = confusion.reshape(num_classes, num_classes).double()
+    t_sum = confusion.sum(dim=1)
+    p_sum = confusion.sum(dim=0)
+    n_correct = confusion.trace()
+    n_samples = confusion.sum()
+    cov_ytyp = n_correct * n_samples - torch.dot(t_sum, p_sum)
+    cov_ypyp = n_samples ** 2 - torch.dot(p_sum, p_sum)
+    cov_ytyt = n_samples ** 2 - torch.dot(t_sum, t_sum)
+    if cov_ypyp * cov_ytyt == 0:
+        return 0.0
+    return (cov_ytyp / torch.sqrt(cov_ytyt * cov_ypyp)).item()
+
+
+def pearson_correlation(x, y):
+    x = x.double() - x.double().mean()
+    y = y.double() - y.double().mean()
+    return (torch.dot(x, y) / torch.sqrt(torch.dot(x, x) * torch.dot(y, y))).item()
+
+
+def rankdata(x):
+    """Ranks starting at 1 with ties getting their average rank, as scipy.stats.rankdata."""
+    sorted_x, order = torch.sort(x)
+    _, counts = torch.unique_consecutive(sorted_x, return_counts=True)
+    ends = torch.cumsum(counts, dim=0).double()
+    average_ranks = ends - (counts.double() - 1) / 2
+    ranks = ends.new_empty(x.shape[0])
+    ranks[order] = torch.repeat_interleave(average_ranks, counts)
+    return ranks
+
+
+def spearman_correlation(x, y):
+    return pearson_correlation(rankdata(x), rankdata(y))
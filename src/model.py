@@ -8,17 +8,15 @@ import random
 from pathlib import Path
 
 import datasets
-import evaluate
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from accelerate import Accelerator
+from accelerate import Accelerator, skip_first_batches
 from accelerate.logging import get_logger
 from accelerate.utils import set_seed
-import evaluate
 
 
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
@@ -38,10 +36,57 @@ from transformers import (
     default_data_collator,
 )
 
-from src.dataset import GLUE_Dataset
+from src.async_eval import AsyncEvaluator
+from src.datacollator import DataCollatorForSyntheticPairs
+from src.dataset import GLUE_Dataset, build_dataloader, file_fingerprint, save_to_cache, tokenized_cache_dir
+from src.frozen import TORCH_DTYPES, FrozenModel
+from src.generator import masked_lm_logits, merge_masked_tokens
+from src.instrumentation import StepTimer, ThroughputMeter, format_phases
+from src.metrics import GlueMetric
+from src.optim import TrainingSteps, is_checkpoint_of
+from src.sample_logging import SampleLogger
+from src.sampling import GumbelSampler
+from src.synthetic import (
+    SyntheticShardWriter,
+    completed_rank_paths,
+    load_synthetic_ids,
+    rank_paths,
+    synthetic_data_paths,
+)
+from src.teacher_cache import TeacherLogitCache, model_fingerprint
 
 logger = get_logger(__name__)
 
+# main.py flag of each pipeline stage, in execution order
+STAGE_FLAGS = {
+    'teacher': 'do_train_teacher',
+    'generator': 'do_train_generator',
+    'generate': 'generate_data',
+    'student': 'do_train_student',
+}
+
+# models and dataloaders touched by each stage
+STAGE_REQUIREMENTS = {
+    'teacher': {'models': ['teacher'], 'data': ['full', 'eval']},
+    'generator': {'models': ['generator', 'teacher', 'student'], 'data': ['few-shot']},
+    # generation prepares its own loader of `--syn_source`, see `generate_synthetic_data`
+    'generate': {'models': ['generator'], 'data': []},
+    'student': {'models': ['teacher', 'student'], 'data': ['synthetic', 'eval']},
+}
+
+
+class LazyDict(dict):
+    """dict that builds missing values with `factory(key)` on first access."""
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, key):
+        value = self[key] = self.factory(key)
+        return value
+
+
 class CILDA:
     def __init__(self, args):
         self.task_num_labels = {
@@ -52,63 +97,252 @@ class CILDA:
         }
 
         self.args = args
-        if torch.cuda.is_available():
-            self.device = torch.device('cuda')
-        else:
-            self.device = torch.device('cpu')
+        # picks the device and, under `accelerate launch`, runs every stage data parallel (gloo all-reduce on cpu)
+        self.accelerator = Accelerator(gradient_accumulation_steps=args.gradient_accumulation_steps)
+        self.device = self.accelerator.device
             
-        # TODO: change MASK BERT to GPT2
-        # self.Generator = GPT2LMHeadModel.from_pretrained(args.generator_model_name)
-        # from transformers import RobertaForSequenceClassification
-
-        # self.G_tokenizer = GPT2Tokenizer.from_pretrained(args.generator_model_name)
         self.tokenizer = AutoTokenizer.from_pretrained(args.teacher_model_name)
-        if args.generator_checkpoint_path is not None:
-            self.Generator = AutoModelForMaskedLM.from_pretrained(args.generator_checkpoint_path).to(self.device)
-        else:
-            self.Generator = AutoModelForMaskedLM.from_pretrained(args.generator_model_name).to(self.device)
-            
         self.num_labels = self.task_num_labels[args.task_name]
 
-        self.S_config = AutoConfig.from_pretrained(args.student_model_name, num_labels=self.num_labels)
-        self.Student = AutoModelForSequenceClassification.from_pretrained(args.student_model_name, config=self.S_config).to(self.device)
-
-        if args.teacher_checkpoint_path is not None:
-            logger.info(f"loading teacher weight from {args.teacher_checkpoint_path}") 
-            self.Teacher = AutoModelForSequenceClassification.from_pretrained(args.teacher_checkpoint_path).to(self.device) 
-        else:
-            self.T_config = AutoConfig.from_pretrained(args.teacher_model_name, num_labels=self.num_labels)
-            self.Teacher = AutoModelForSequenceClassification.from_pretrained(args.teacher_model_name, config=self.T_config).to(self.device)
-
-        
         # self.t_proj = nn.Linear(self.Teacher.config.intermediate_size, args.intermediate_hidden_size)
         # self.s_proj = nn.Linear(self.Student.config.intermediate_size, args.intermediate_hidden_size)
 
         self.select_k_per_class = args.select_k_per_class
-        
-        self.data_dict = self.get_data_dict(args.task_name)
-            
-    
-    def get_data_dict(self, task):
-        data_dict = {}
-        dataset = GLUE_Dataset(self.args, self.tokenizer)
-        
+        self.sampler = GumbelSampler(tau=1.0)
+        self.teacher_cache = None
+        self.quantized_teacher = None
+        self.metric = None
+        # throughput summary of every stage that ran, see `ThroughputMeter`
+        self.throughput = {}
+        # the only way the stage loops log text samples and losses
+        self.sample_logger = SampleLogger(
+            self.tokenizer,
+            samples_every=args.log_samples_every,
+            metrics_every=args.log_metrics_every,
+            max_records_per_second=args.log_max_records_per_second,
+            enabled=self.accelerator.is_main_process,
+        )
+
+        # models and dataloaders are built the first time a stage touches them,
+        # and released once no later requested stage needs them (see `finish_stage`)
+        self.stages = [stage for stage, flag in STAGE_FLAGS.items() if getattr(args, flag)]
+        self.models = {}
+        self.glue_dataset = None
+        self.data_dict = LazyDict(self.prepare_dataloader)
+
+        # an explicit checkpoint that belongs to none of the requested stages would silently train from scratch
+        resume_from_checkpoint = args.resume_from_checkpoint
+        if resume_from_checkpoint and resume_from_checkpoint != 'latest':
+            if not any(is_checkpoint_of(resume_from_checkpoint, self.checkpoint_dir(stage)) for stage in self.stages):
+                raise ValueError(
+                    f"--resume_from_checkpoint {resume_from_checkpoint} is not in output_dir/checkpoints/<stage> "
+                    f"of any requested stage ({', '.join(self.stages)})"
+                )
+
+    @property
+    def Generator(self):
+        return self.get_model('generator')
+
+    @property
+    def Teacher(self):
+        return self.get_model('teacher')
+
+    @property
+    def Student(self):
+        return self.get_model('student')
+
+    def autocast(self):
+        """Context for the forwards, bf16 autocast with `--precision bf16`. Weights and optimizer states stay fp32."""
+        return torch.autocast(
+            device_type=self.device.type, dtype=torch.bfloat16, enabled=self.args.precision == 'bf16'
+        )
+
+    def step_timer(self, meter):
+        """`StepTimer` of the stage counted by `meter`, as configured by `--step_timing` and `--profile_steps`."""
+        args = self.args
+        profile_path = None
+        if args.profile_steps is not None:
+            profile_dir = args.profile_dir or os.path.join(args.output_dir, 'profile')
+            profile_path = os.path.join(profile_dir, f"{meter.stage}-rank{self.accelerator.process_index}.json")
+        return StepTimer(
+            meter,
+            self.device,
+            enabled=args.step_timing,
+            log_every=args.log_timing_every,
+            profile_steps=args.profile_steps,
+            profile_path=profile_path,
+        )
+
+    def record_throughput(self, meter, timer=None):
+        summary = meter.summary()
+        logger.info(
+            f"{meter.stage} throughput: {summary['steps_per_second']:.2f} steps/s, "
+            f"{summary['examples_per_second']:.1f} examples/s, {summary['tokens_per_second']:.1f} tokens/s, "
+            f"padding {summary['padding_ratio']:.1%} over {summary['seconds']:.1f}s ({self.args.precision})"
+        )
+        if timer is not None:
+            timer.finish()
+            if timer.enabled:
+                summary['phases'] = timer.summary()
+                logger.info(f"{meter.stage} step time: {format_phases(timer.totals, timer.total_steps)}")
+        self.throughput[meter.stage] = summary
+
+    def frozen_teacher(self):
+        """The teacher as used by the distillation stages: frozen, inference mode, in `--teacher_dtype`."""
+        if self.args.quantize_teacher:
+            if self.quantized_teacher is None:
+                self.quantized_teacher = self.select_quantized_teacher()
+            return self.quantized_teacher
+        return FrozenModel(self.Teacher, dtype=TORCH_DTYPES[self.args.teacher_dtype])
+
+    def select_quantized_teacher(self):
+        """
+        Quantize the teacher's linear layers to int8 and compare it with the float32 teacher on the eval set.
+        The quantized teacher is used if its metric drops by at most `--quantize_teacher_max_metric_drop`.
+        """
+        args = self.args
+        if self.device.type != 'cpu':
+            logger.warning(f"int8 dynamic quantization only runs on cpu, keeping the teacher on {self.device}")
+            return FrozenModel(self.Teacher, dtype=TORCH_DTYPES[args.teacher_dtype])
+
+        reference = FrozenModel(self.Teacher.float())
+        quantized = FrozenModel(self.Teacher, quantize=True)
+        reference_metric = self.eval_on_clf(reference)
+        quantized_metric = self.eval_on_clf(quantized)
+        deltas = {k: quantized_metric[k] - reference_metric[k] for k in reference_metric}
+        logger.info(f"teacher eval fp32: {reference_metric}, int8: {quantized_metric}, delta: {deltas}")
+
+        # the first score is the main one, e.g. accuracy or matthews_correlation
+        key = next(iter(reference_metric))
+        if -deltas[key] > args.quantize_teacher_max_metric_drop:
+            logger.warning(
+                f"int8 teacher {key} drops by {-deltas[key]:.4f} > {args.quantize_teacher_max_metric_drop}, "
+                "keeping the unquantized teacher"
+            )
+            return FrozenModel(self.Teacher, dtype=TORCH_DTYPES[args.teacher_dtype])
+        return quantized
+
+    def get_model(self, model_name):
+        if model_name not in self.models:
+            self.models[model_name] = self.load_model(model_name).to(self.device)
+        return self.models[model_name]
+
+    def load_model(self, model_name):
+        args = self.args
+        if model_name == 'generator':
+            # TODO: change MASK BERT to GPT2
+            # self.Generator = GPT2LMHeadModel.from_pretrained(args.generator_model_name)
+            # self.G_tokenizer = GPT2Tokenizer.from_pretrained(args.generator_model_name)
+            if args.generator_checkpoint_path is not None:
+                return AutoModelForMaskedLM.from_pretrained(args.generator_checkpoint_path)
+            return AutoModelForMaskedLM.from_pretrained(args.generator_model_name)
+        elif model_name == 'student':
+            self.S_config = AutoConfig.from_pretrained(args.student_model_name, num_labels=self.num_labels)
+            return AutoModelForSequenceClassification.from_pretrained(args.student_model_name, config=self.S_config)
+        elif model_name == 'teacher':
+            if args.teacher_checkpoint_path is not None:
+                logger.info(f"loading teacher weight from {args.teacher_checkpoint_path}") 
+                return AutoModelForSequenceClassification.from_pretrained(args.teacher_checkpoint_path)
+            self.T_config = AutoConfig.from_pretrained(args.teacher_model_name, num_labels=self.num_labels)
+            return AutoModelForSequenceClassification.from_pretrained(args.teacher_model_name, config=self.T_config)
+        raise KeyError(f"Error key model_name {model_name}")
+
+    def prepare_dataloader(self, name, even_batches=True):
+        # the main process builds the dataset caches first, the others load them
+        with self.accelerator.main_process_first():
+            dataloader = self.get_dataloader(name)
+        # every process iterates over its own shard of the batches, with `even_batches` the shards that come up
+        # short repeat examples from the start so that all processes run the same number of batches.
+        # batches stay on the cpu, the loops move them to the device themselves (the `h2d` phase of `StepTimer`)
+        accelerator = self.accelerator
+        accelerator.even_batches = even_batches
+        try:
+            return accelerator.prepare_data_loader(dataloader, device_placement=False)
+        finally:
+            accelerator.even_batches = True
+
+    def checkpoint_dir(self, stage):
+        if self.args.output_dir is None:
+            return None
+        return os.path.join(self.args.output_dir, 'checkpoints', stage)
+
+    def training_steps(self, stage, optimizer, dataloader, train_epochs, extra_models=None):
+        """`TrainingSteps` of `stage`, checkpointed to `output_dir/checkpoints/{stage}` with `--checkpointing_steps`."""
+        args = self.args
+        return TrainingSteps(
+            self.accelerator,
+            optimizer,
+            len(dataloader),
+            train_epochs,
+            max_train_steps=args.max_train_steps,
+            checkpoint_dir=self.checkpoint_dir(stage),
+            checkpointing_steps=args.checkpointing_steps,
+            extra_models=extra_models,
+        )
+
+    def save_model(self, model, save_path):
+        """Only the main process writes `model`, the others wait until it is on disk."""
+        accelerator = self.accelerator
+        accelerator.wait_for_everyone()
+        accelerator.unwrap_model(model).save_pretrained(
+            save_path, is_main_process=accelerator.is_main_process, save_function=accelerator.save
+        )
+        accelerator.wait_for_everyone()
+
+    def average_gradients(self, model):
+        # for models that are not wrapped in DistributedDataParallel
+        if self.accelerator.num_processes == 1:
+            return
+        for param in model.parameters():
+            if param.grad is not None:
+                param.grad = self.accelerator.reduce(param.grad, reduction='mean')
+
+    def get_dataloader(self, name):
+        args = self.args
+        task = args.task_name
+        if name == 'synthetic':
+            return self.get_synthetic_dataset()
+
+        if self.glue_dataset is None:
+            self.glue_dataset = GLUE_Dataset(args, self.tokenizer)
+        dataset = self.glue_dataset
+
         k = self.select_k_per_class
         k_val = 500
-        print('k = ', k, '  k-val = ',k_val)
-        
-        few_dataloader = dataset.get_final_ds(task=task, batch_size=self.args.batch_size, split='train', k=k)
-        full_dataloader = dataset.get_final_ds(task=task, batch_size=self.args.batch_size, split='train', k=-1)
-        eval_dataloader = dataset.get_final_ds(task=task, batch_size=self.args.batch_size, split='validation', k=k_val)
-        test_dataloader = dataset.get_final_ds(task=task, batch_size=self.args.batch_size, split='test', k=-1)
-        
-        data_dict['few-shot'] = few_dataloader
-        data_dict['full'] = full_dataloader
-        data_dict['eval'] = eval_dataloader
-        data_dict['test'] = test_dataloader
-
-        return data_dict
-    
+        logger.info(f"building {name} dataloader, k = {k}, k-val = {k_val}")
+
+        if name == 'few-shot':
+            return dataset.get_final_ds(task=task, batch_size=args.batch_size, split='train', k=k)
+        elif name == 'full':
+            return dataset.get_final_ds(task=task, batch_size=args.batch_size, split='train', k=-1)
+        elif name == 'eval':
+            return dataset.get_final_ds(task=task, batch_size=args.batch_size, split='validation', k=k_val)
+        elif name == 'test':
+            return dataset.get_final_ds(task=task, batch_size=args.batch_size, split='test', k=-1)
+        raise KeyError(f"Error key dataloader {name}")
+
+    def finish_stage(self, stage):
+        """Release the models and dataloaders that no stage requested after `stage` needs."""
+        remaining = self.stages[self.stages.index(stage) + 1:] if stage in self.stages else []
+        requirements = STAGE_REQUIREMENTS
+        needed_models = {m for s in remaining for m in requirements[s]['models']}
+        needed_data = {d for s in remaining for d in requirements[s]['data']}
+
+        for model_name in [m for m in self.models if m not in needed_models]:
+            logger.info(f"releasing {model_name} after {stage} stage")
+            del self.models[model_name]
+        for name in [d for d in self.data_dict if d not in needed_data]:
+            del self.data_dict[name]
+        if 'synthetic' not in needed_data:
+            self.teacher_cache = None
+        if 'teacher' not in self.models:
+            self.quantized_teacher = None
+        if not needed_data - {'synthetic'}:
+            self.glue_dataset = None
+
+        # drops the accelerator's references to the prepared models, optimizers and dataloaders
+        self.accelerator.free_memory()
+        self.sample_logger.flush()
 
     def get_optimizer(self, model_name):
         args = self.args
@@ -144,318 +378,462 @@ class CILDA:
         model.train()
 
         optimizer = self.get_optimizer(model_name='teacher')
+        model, optimizer = self.accelerator.prepare(model, optimizer)
        
-        metric = evaluate.load('glue', self.args.task_name)
-        
         train_dataloader = self.data_dict['full']
         eval_dataloader = self.data_dict['eval']
 
-        num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
-        
-        max_train_steps = args.max_train_steps
-        if args.max_train_steps is None:
-            max_train_steps = train_epochs * num_update_steps_per_epoch
-
-        train_epochs = math.ceil(max_train_steps / num_update_steps_per_epoch) 
-        total_batch_size = args.per_device_train_batch_size * args.gradient_accumulation_steps
-
-        logger.info("***** Running Teacher training *****")
-        logger.info(f"  Num Epochs = {train_epochs}")
-        logger.info(f"  Instantaneous batch size per device = {args.per_device_train_batch_size}")
-        logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
-        logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
-        logger.info(f"  Total optimization steps = {max_train_steps}")
-
-        progress_bar = tqdm(range(max_train_steps))
-        for epoch in range(train_epochs):
+        steps = self.training_steps('teacher', optimizer, train_dataloader, train_epochs)
+        steps.log_plan('Teacher', args.batch_size)
+        steps.resume(args.resume_from_checkpoint)
+
+        evaluator = None
+        if args.async_eval and self.accelerator.is_main_process:
+            # the worker evaluates the whole eval set, so only the main process runs one
+            evaluator = AsyncEvaluator(
+                self.accelerator.unwrap_model(model), eval_dataloader.dataset, eval_dataloader.collate_fn,
+                args.batch_size, args.task_name,
+                precision=args.precision, num_threads=args.async_eval_threads, name='teacher eval',
+            )
+
+        meter = ThroughputMeter('teacher')
+        timer = self.step_timer(meter)
+        # stays `None` when resumed from the checkpoint of the last epoch, so there is no epoch left to run
+        epoch = None
+        for epoch in steps.epochs():
             model.train()
             if args.with_tracking:
                 total_loss = 0
-            active_dataloader = train_dataloader
-            for step, batch in enumerate(active_dataloader):
-                batch = {k : batch[k].to(self.device) for k in batch}
-                outputs = model(
-                    input_ids=batch['input_ids'],
-                    attention_mask=batch['attention_mask'],
-                    labels=batch['clf_labels']
-                    )
-                loss = outputs.loss
-                # We keep track of the loss at each epoch
-                if args.with_tracking:
-                    total_loss += loss.detach().float()
-                loss = loss / args.gradient_accumulation_steps
-                loss.backward()
-
-                if step % 3*args.gradient_accumulation_steps == 0 or step == len(active_dataloader) - 1:
-                    optimizer.step()
-                    optimizer.zero_grad()
-                    progress_bar.update(1)
-
-                # evaluation
-                if step % args.eval_every_step == 0:
-                    eval_metric = self.eval_on_clf(model)
-                    logger.info(f'epoch {epoch}: {eval_metric}')
-
-        save_path = os.path.join(self.args.output_dir, 'few-shot')
+            for step, batch in timer.batches(steps.epoch_batches(train_dataloader, epoch)):
+                with timer.phase('h2d'):
+                    batch = {k : batch[k].to(self.device) for k in batch}
+                with steps.accumulate(model):
+                    with self.autocast(), timer.phase('teacher_forward'):
+                        outputs = model(
+                            input_ids=batch['input_ids'],
+                            attention_mask=batch['attention_mask'],
+                            labels=batch['clf_labels']
+                            )
+                    loss = outputs.loss
+                    meter.update(batch['attention_mask'])
+                    # We keep track of the loss at each epoch
+                    if args.with_tracking:
+                        total_loss += loss.detach().float()
+                    # scaled by 1 / gradient_accumulation_steps
+                    with timer.phase('backward'):
+                        self.accelerator.backward(loss)
+                    with timer.phase('optimizer'):
+                        stepped = steps.step()
+                with timer.phase('checkpoint'):
+                    steps.maybe_save_checkpoint(epoch, step, stepped=stepped)
+
+                # evaluation, every `eval_every_step` optimizer steps
+                if stepped and steps.completed_steps % args.eval_every_step == 0:
+                    with timer.phase('eval'):
+                        if args.async_eval:
+                            if evaluator is not None:
+                                evaluator.submit(self.accelerator.unwrap_model(model), epoch=epoch, step=steps.completed_steps)
+                        else:
+                            eval_metric = self.eval_on_clf(model)
+                            logger.info(f'epoch {epoch}: {eval_metric}')
+                            model.train()
+                elif evaluator is not None:
+                    evaluator.poll()
+                if steps.done:
+                    break
+            if steps.done:
+                break
+            steps.maybe_save_checkpoint(epoch, end_of_epoch=True)
+        self.record_throughput(meter, timer)
+        if evaluator is not None:
+            # the final weights are evaluated too, not only the ones of the last `eval_every_step`
+            evaluator.close(self.accelerator.unwrap_model(model), epoch=epoch, step=steps.completed_steps)
+
+        save_path = os.path.join(self.args.output_dir, 'teacher')
         print(save_path)
-        model.save_pretrained(save_path)
+        self.save_model(model, save_path)
 
 
     def eval_on_clf(self, model):
         model.eval()
-        metric = evaluate.load('glue', self.args.task_name)
         eval_dataloader = self.data_dict['eval']
+        if self.metric is None:
+            self.metric = GlueMetric(self.args.task_name)
+        metric = self.metric
+        metric.reset(num_examples=len(eval_dataloader.dataset))
 
         for _, batch in enumerate(eval_dataloader):
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 batch = {k : batch[k].to(self.device) for k in batch}
                 outputs = model(
                     input_ids=batch['input_ids'],
                     attention_mask=batch['attention_mask'],
                     labels=batch['clf_labels'] 
                 )
-            predictions = outputs.logits.argmax(dim=-1)
-            references  = batch['clf_labels']
+            # collect the shards of all processes, without the samples repeated to even out the last batch
+            logits, references = self.accelerator.gather_for_metrics((outputs.logits, batch['clf_labels']))
             metric.add_batch(
-                predictions=predictions,
+                logits=logits,
                 references=references,
             )
         eval_metric = metric.compute()
         return eval_metric
 
+    def log_samples(self, stage, batch, step):
+        # only the first example, decoded in the background by `sample_logger`
+        self.sample_logger.log_samples(
+            stage, step, syn_text=batch['synthetic_input_ids'][0], ori_text=batch['input_ids'][0]
+        )
+
     def train_generator(self, train_epochs):
         generator = self.Generator
-        teacher = self.Teacher
+        teacher = self.frozen_teacher()
         student = self.Student
-        teacher.eval()
         student.eval()
         
         # adversarial training
         args = self.args
-        g_optimizer = self.get_optimizer('generator')
+        g_optimizer = self.accelerator.prepare(self.get_optimizer('generator'))
         
-        metric = evaluate.load('glue', self.args.task_name)
         train_dataloader = self.data_dict['few-shot']
-        num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
-        
-        max_train_steps = args.max_train_steps
-        if args.max_train_steps is None:
-            max_train_steps = train_epochs * num_update_steps_per_epoch
+        # the generator is not prepared, so its weights are checkpointed next to the accelerator state
+        steps = self.training_steps(
+            'generator', g_optimizer, train_dataloader, train_epochs, extra_models={'generator': generator}
+        )
+        steps.log_plan('ADV', args.batch_size)
+        steps.resume(args.resume_from_checkpoint)
         
-        train_epochs = math.ceil(max_train_steps / num_update_steps_per_epoch) 
-        total_batch_size = args.per_device_train_batch_size * args.gradient_accumulation_steps
-        
-        logger.info("***** Running ADV training *****")
-        logger.info(f"  Num Epochs = {train_epochs}")
-        logger.info(f"  Instantaneous batch size per device = {args.per_device_train_batch_size}")
-        logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
-        logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
-        logger.info(f"  Total optimization steps = {max_train_steps}")
-        logger.info(f"  num_update_steps_per_epoch = {num_update_steps_per_epoch}")
-        
-        for epoch in range(train_epochs):
-            for i, batch in enumerate(tqdm(train_dataloader)):
+        meter = ThroughputMeter('generator')
+        timer = self.step_timer(meter)
+        for epoch in steps.epochs():
+            for i, batch in timer.batches(steps.epoch_batches(train_dataloader, epoch)):
                 # train generator
-                logger.info("training the genrator")
                 generator.train()
                 student.eval()
-                batch = {k : batch[k].to(self.device) for k in batch}
-                batch_size = batch['input_ids'].shape[0]
-                seq_len = batch['input_ids'].shape[1]
-                outputs = generator(
-                    input_ids=batch['input_ids'],
-                    attention_mask=batch['attention_mask'],
-                )
-                logits = outputs.logits
-                # mask.shape -> (batch, seq_len, embed_dim)
-                mask = F.gumbel_softmax(logits, tau=1, hard=True, dim=-1)
-                idx = torch.arange(0, self.tokenizer.vocab_size, dtype=torch.float32, device=self.device, requires_grad=True).reshape(1, 1, -1).repeat(batch_size, seq_len, 1)
-                
-                # synthetic data.shape - > (batch, seq)
-                synthetic_data = torch.sum(mask * idx , dim=2).long() * batch['attention_mask']
-                batch['synthetic_input_ids'] = batch['input_ids'].clone()
-                # only change the mask_idx 
-                # puts label back to input_ids
-
-                for i in range(batch_size):
-                    mask_idx = (batch['lm_labels'][i] != -100).nonzero().squeeze()
-                    batch['input_ids'][i][mask_idx] = batch['lm_labels'][i][mask_idx]
-                    batch['synthetic_input_ids'][i][mask_idx] = synthetic_data[i][mask_idx]
-                    logger.info(f"syn_text:{self.tokenizer.decode(batch['synthetic_input_ids'][i],skip_special_tokens=True)}")
-                    logger.info(f"ori_text:{self.tokenizer.decode(batch['input_ids'][i],skip_special_tokens=True)}")
-                    logger.info("*"*10)
+                with timer.phase('h2d'):
+                    batch = {k : batch[k].to(self.device) for k in batch}
+                with steps.accumulate(generator):
+                    # logits are only computed where the collator masked tokens: (num_masked, vocab)
+                    masked_indices = batch['lm_labels'] != -100
+                    with self.autocast(), timer.phase('generator_forward'):
+                        logits = masked_lm_logits(
+                            generator,
+                            input_ids=batch['input_ids'],
+                            attention_mask=batch['attention_mask'],
+                            masked_indices=masked_indices,
+                        )
+                    with timer.phase('sampling'):
+                        # the teacher and student only see the discrete ids, so the straight-through ids would be
+                        # thrown away: sample from detached logits to skip computing them
+                        sampled_ids, _ = self.sampler(logits.detach().float())
+                    # only change the masked positions: puts label back to input_ids
+                    # and the sampled tokens into synthetic_input_ids, both (batch, seq)
+                    batch['input_ids'], batch['synthetic_input_ids'] = merge_masked_tokens(
+                        batch['input_ids'], batch['lm_labels'], sampled_ids
+                    )
+                    self.log_samples('generator', batch, step=i)
                 
-                # compare and KL loss
-                # logits.shape -> (batch, num_labels)
-                teacher_logits = teacher(
-                    input_ids=batch['synthetic_input_ids'],
-                    # attention_mask=batch['attention_mask'],
-                ).logits
-                student_logits = student(
-                    input_ids=batch['synthetic_input_ids'],
-                    # attention_mask=batch['attention_mask'],
-                ).logits
+                    # compare and KL loss
+                    # logits.shape -> (batch, num_labels)
+                    # the synthetic ids share the padding of the real ones
+                    with self.autocast():
+                        with timer.phase('teacher_forward'):
+                            teacher_logits = teacher(
+                                input_ids=batch['synthetic_input_ids'],
+                                attention_mask=batch['attention_mask'],
+                            ).logits
+                        with timer.phase('student_forward'):
+                            student_logits = student(
+                                input_ids=batch['synthetic_input_ids'],
+                                attention_mask=batch['attention_mask'],
+                            ).logits
                 
-                loss = -torch.nn.KLDivLoss()(teacher_logits, student_logits)
+                    loss = -torch.nn.KLDivLoss()(teacher_logits.float(), student_logits.float())
                 
-                loss.backward()
-                g_optimizer.step()
-                g_optimizer.zero_grad()
+                    with timer.phase('backward'):
+                        self.accelerator.backward(loss)
+                    with timer.phase('optimizer'):
+                        if steps.sync_gradients:
+                            # `masked_lm_logits` calls the generator's submodules directly, so it is not DDP wrapped
+                            self.average_gradients(generator)
+                        stepped = steps.step()
+                if stepped:
+                    self.sample_logger.log_metrics('generator', steps.completed_steps, loss=loss)
+                with timer.phase('checkpoint'):
+                    steps.maybe_save_checkpoint(epoch, i, stepped=stepped)
+                meter.update(batch['attention_mask'])
+                if steps.done:
+                    break
+            if steps.done:
+                break
+            steps.maybe_save_checkpoint(epoch, end_of_epoch=True)
+        self.record_throughput(meter, timer)
 
         # test on this
         generator_save_path = os.path.join(self.args.output_dir, 'generator')
-        generator.save_pretrained(generator_save_path)
+        self.save_model(generator, generator_save_path)
     
     def generate_synthetic_data(self, syn_data_output_path):
+        args = self.args
         generator = self.Generator
         generator.eval()
 
-        all_synthetic_data = []
-        all_real_data = []
-        real_label = []
+        # without the repeated examples of even batches, they would be written as duplicate synthetic rows
+        dataloader = self.prepare_dataloader(args.syn_source, even_batches=False)
+        ids_path, text_path = synthetic_data_paths(syn_data_output_path)
+        # every process generates from its own shard of the source into its own files
+        ids_path, text_path = rank_paths(ids_path, text_path, self.accelerator.process_index)
+        write_text = args.syn_data_format == 'text' or args.save_syn_text
+        # token ids are written as is, the text round trip would re-segment the sampled tokens
+        writer = SyntheticShardWriter(
+            ids_path,
+            shard_size=args.syn_shard_size,
+            settings={
+                'source': args.syn_source,
+                'rounds': args.syn_generation_rounds,
+                'samples_per_input': args.num_samples_per_input,
+                'resample_mask_probability': args.resample_mask_probability,
+                'format': args.syn_data_format,
+                'num_processes': self.accelerator.num_processes,
+                # what decides the source batches and the sampled tokens, `batches_done` counts those batches
+                'task_name': args.task_name,
+                'data': self.glue_dataset.source,
+                'select_k_per_class': args.select_k_per_class,
+                'seed': args.seed,
+                'batch_size': args.batch_size,
+                'max_length': args.max_length,
+                'pad_to_max_length': args.pad_to_max_length,
+                'group_by_length': args.group_by_length,
+                'mlm_probability': args.mlm_probability,
+                'generator': model_fingerprint(generator),
+            },
+            tokenizer=self.tokenizer,
+            write_ids=args.syn_data_format == 'ids',
+            text_path=text_path if write_text else None,
+        )
+        num_batches = args.syn_generation_rounds * len(dataloader)
+        num_samples = args.num_samples_per_input
+        if writer.batches_done:
+            logger.info(f"resuming synthetic data generation after {writer.batches_done} batches", main_process_only=False)
+
+        progress_bar = tqdm(
+            range(num_batches), initial=writer.batches_done, disable=not self.accelerator.is_local_main_process
+        )
+        meter = ThroughputMeter('generate')
+        timer = self.step_timer(meter)
         with torch.no_grad():
-            for i, batch in enumerate(tqdm(self.data_dict['few-shot'])):
-                batch = {k : batch[k].to(self.device) for k in batch}
-                batch_size = batch['input_ids'].shape[0]
-                seq_len = batch['input_ids'].shape[1]
-                outputs = generator(
-                    input_ids=batch['input_ids'],
-                    attention_mask=batch['attention_mask'],
-                )
-                logits = outputs.logits
-                # mask.shape -> (batch, seq_len, embed_dim)
-                mask = F.gumbel_softmax(logits, tau=1, hard=True, dim=-1)
-                idx = torch.arange(0, self.tokenizer.vocab_size, dtype=torch.float32, requires_grad=True, device=self.device).reshape(1, 1, -1).repeat(batch_size, seq_len, 1)
+            for round_idx in range(writer.batches_done // len(dataloader), args.syn_generation_rounds):
+                # skip the batches already written by a previous run
+                resume_step = writer.batches_done - round_idx * len(dataloader)
+                # every round is its own epoch of the sampler (`--group_by_length`), also in a resumed run
+                dataloader.set_epoch(round_idx)
+                active_dataloader = skip_first_batches(dataloader, resume_step) if resume_step > 0 else dataloader
+                for i, batch in timer.batches(enumerate(active_dataloader, start=max(resume_step, 0))):
+                    with timer.phase('h2d'):
+                        batch = {k : batch[k].to(self.device) for k in batch}
+                    # logits are only computed where the collator masked tokens: (num_masked, vocab)
+                    masked_indices = batch['lm_labels'] != -100
+                    meter.update(batch['attention_mask'])
+                    with self.autocast(), timer.phase('generator_forward'):
+                        logits = masked_lm_logits(
+                            generator,
+                            input_ids=batch['input_ids'],
+                            attention_mask=batch['attention_mask'],
+                            masked_indices=masked_indices,
+                        ).float()
+                    # the generator forward is shared by all variants, only the gumbel noise differs: (N, num_masked)
+                    with timer.phase('sampling'):
+                        sampled_ids, _ = self.sampler(logits.unsqueeze(0).expand(num_samples, -1, -1))
+                    if args.resample_mask_probability > 0:
+                        # every variant only replaces its own random subset of the masked positions
+                        replace = torch.rand(sampled_ids.shape, device=sampled_ids.device) < args.resample_mask_probability
+                        sampled_ids = torch.where(replace, sampled_ids, batch['lm_labels'][masked_indices])
+                    # variants are stacked along the batch dimension, (N * batch, seq)
+                    batch = {k: batch[k].repeat(num_samples, 1) for k in ['input_ids', 'lm_labels', 'attention_mask', 'clf_labels']}
+                    # only change the masked positions: puts label back to input_ids
+                    # and the sampled tokens into synthetic_input_ids
+                    batch['input_ids'], batch['synthetic_input_ids'] = merge_masked_tokens(
+                        batch['input_ids'], batch['lm_labels'], sampled_ids.reshape(-1)
+                    )
+                    self.log_samples('generate', batch, step=i)
 
-                
-                # synthetic data.shape - > (batch, seq)
-                synthetic_data = torch.sum(mask * idx , dim=2).long() * batch['attention_mask']
-                batch['synthetic_input_ids'] = batch['input_ids'].clone()
-                # only change the mask_idx 
-                # puts label back to input_ids
-                for i in range(batch_size):
-                    mask_idx = (batch['lm_labels'][i] != -100).nonzero().squeeze()
-                    batch['input_ids'][i][mask_idx] = batch['lm_labels'][i][mask_idx]
-                    batch['synthetic_input_ids'][i][mask_idx] = synthetic_data[i][mask_idx]
-                    logger.info(f"syn_text:{self.tokenizer.decode(batch['synthetic_input_ids'][i],skip_special_tokens=True)}")
-                    logger.info(f"ori_text:{self.tokenizer.decode(batch['input_ids'][i],skip_special_tokens=True)}")
-                    logger.info("*"*10)
-                
-                
-                all_real_data.append(batch['input_ids']) 
-                all_synthetic_data.append(batch['synthetic_input_ids'])
-                real_label.append(batch['clf_labels']) 
-        
-        # combine all data
-        all_synthetic_data = torch.cat(all_synthetic_data, dim=0).to(self.device)
-        all_real_data = torch.cat(all_real_data, dim=0).to(self.device)
-        real_label = torch.cat(real_label, dim=0).to(self.device)
-        
-        real_text      = self.tokenizer.batch_decode(all_real_data, skip_special_tokens=True)
-        synthetic_text = self.tokenizer.batch_decode(all_synthetic_data, skip_special_tokens=True)
-        real_label = real_label.detach().cpu().numpy().tolist()
-        augmented_dataset = [
-                {"ori_text":text, "syn_text": syn_text, "label":label} \
-                for text, syn_text, label in zip(real_text, synthetic_text, real_label)
-            ]
-        
-        # write constructed data into json file
-        with open(syn_data_output_path, 'w') as jsonfile:
-            json.dump(augmented_dataset, jsonfile)
+                    with timer.phase('write'):
+                        writer.write_batch(
+                            batch['input_ids'], batch['synthetic_input_ids'], batch['attention_mask'], batch['clf_labels']
+                        )
+                    progress_bar.update(1)
+        writer.close()
+        self.record_throughput(meter, timer)
+        logger.info(
+            f"wrote {writer.num_rows} synthetic examples to {ids_path if writer.write_ids else text_path}",
+            main_process_only=False,
+        )
+        self.accelerator.wait_for_everyone()
     
     def get_synthetic_dataset(self):
         args = self.args
         tokenizer = self.tokenizer
         max_length = args.max_length
         
-        file_path = os.path.join('data', args.syn_data_path)
-        raw_datasets = load_dataset('json',data_files=file_path)
+        ids_path, file_path = synthetic_data_paths(os.path.join('data', args.syn_data_path))
+        rank_ids_paths, rank_text_paths = zip(*completed_rank_paths(ids_path, file_path))
+
+        padding = 'max_length' if args.pad_to_max_length else False
 
-        def preproces_fn(examples):
-            inputs = tokenizer(examples['ori_text'], padding='max_length', max_length=max_length, truncation=True)
-            syn_input = tokenizer(examples['syn_text'], padding='max_length', max_length=max_length, truncation=True).input_ids
+        def preproces_fn(examples, indices):
+            inputs = tokenizer(examples['ori_text'], padding=padding, max_length=max_length, truncation=True)
+            syn_input = tokenizer(examples['syn_text'], padding=padding, max_length=max_length, truncation=True)
 
-            inputs['syn_input_ids'] = syn_input
+            inputs['syn_input_ids'] = syn_input.input_ids
+            inputs['syn_attention_mask'] = syn_input.attention_mask
             inputs['labels'] = examples['label']
+            # row index, used to look up cached teacher logits
+            inputs['idx'] = indices
             return inputs
 
-        process_ds = raw_datasets.map(preproces_fn, batched=True)
-        process_ds.remove_columns(column_names=raw_datasets['train'].column_names)
-        process_ds.set_format('torch', columns=['input_ids', 'attention_mask', 'labels', 'syn_input_ids'])
-
-        data_collator = DataCollatorWithPadding(tokenizer, padding=True,pad_to_multiple_of=8)
-        dataloader = DataLoader(process_ds['train'], collate_fn=data_collator, batch_size=args.batch_size)
-        self.data_dict['synthetic'] = dataloader
-        return 
+        if args.syn_data_format == 'ids':
+            # already token ids, nothing to tokenize
+            process_ds = load_synthetic_ids(list(rank_ids_paths))
+            columns = ['input_ids', 'attention_mask', 'labels', 'syn_input_ids', 'idx']
+        else:
+            process_ds = self.tokenize_synthetic_text(list(rank_text_paths), preproces_fn)
+            columns = ['input_ids', 'attention_mask', 'labels', 'syn_input_ids', 'syn_attention_mask', 'idx']
+        process_ds.set_format('torch', columns=columns)
+
+        data_collator = DataCollatorForSyntheticPairs(
+            tokenizer, pad_to_multiple_of=8, pad_pairs_to_same_length=args.fuse_student_forward
+        )
+        dataloader = build_dataloader(args, process_ds, collate_fn=data_collator, batch_size=args.batch_size)
+
+        if args.cache_teacher_logits:
+            self.teacher_cache = TeacherLogitCache(
+                cache_dir=os.path.dirname(file_path), teacher=self.frozen_teacher(), dataset=process_ds
+            ).load(dataloader, self.device)
+        return dataloader
+
+    def tokenize_synthetic_text(self, file_paths, preproces_fn):
+        args = self.args
+        data = '-'.join(file_fingerprint(file_path) for file_path in file_paths)
+        cache_dir = tokenized_cache_dir(args, self.tokenizer, name='synthetic', data=data)
+        if cache_dir is not None and os.path.isdir(cache_dir) and not args.overwrite_cache:
+            process_ds = load_from_disk(cache_dir)
+        else:
+            raw_datasets = load_dataset('json',data_files=file_paths)
+            process_ds = raw_datasets['train'].map(
+                preproces_fn, batched=True, with_indices=True, num_proc=args.preprocessing_num_workers
+            )
+            if cache_dir is not None:
+                save_to_cache(process_ds, cache_dir)
+                # reload, so every process sees the same dataset fingerprint for the teacher logit cache
+                process_ds = load_from_disk(cache_dir)
+        return process_ds
                 
     def train_student(self, train_epochs):
         args = self.args
         
-        generator = self.Generator
-        teacher = self.Teacher
+        teacher = self.frozen_teacher()
         student = self.Student
-        teacher.eval()
-        generator.eval()
         
         s_optimizer = self.get_optimizer('student')
+        student, s_optimizer = self.accelerator.prepare(student, s_optimizer)
         
-        if 'synthetic' not in self.data_dict:
-            self.get_synthetic_dataset()
-            
         train_dataloader = self.data_dict['synthetic']
-        num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
-        
-        max_train_steps = args.max_train_steps
-        if args.max_train_steps is None:
-            max_train_steps = train_epochs * num_update_steps_per_epoch
-        
-        train_epochs = math.ceil(max_train_steps / num_update_steps_per_epoch) 
-        total_batch_size = args.per_device_train_batch_size * args.gradient_accumulation_steps
+        teacher_cache = self.teacher_cache if args.cache_teacher_logits else None
+        steps = self.training_steps('student', s_optimizer, train_dataloader, train_epochs)
+        steps.log_plan('Student', args.batch_size)
+        steps.resume(args.resume_from_checkpoint)
         
         # train a student
-        for epoch in range(train_epochs):
+        meter = ThroughputMeter('student')
+        timer = self.step_timer(meter)
+        for epoch in steps.epochs():
             logger.info("training on student")
             student.train()
-            for i, batch in enumerate(tqdm(train_dataloader)): 
-                batch = {k : batch[k].to(self.device) for k in batch}
-                
-                # few-shot dataset
-                real_teacher_logits = teacher(
-                    input_ids=batch['input_ids'],
-                ).logits
-                real_student_output = student(
-                    input_ids=batch['input_ids'],
-                    labels=batch['labels'],
-                )
-                
-                # syn_data training
-                syn_teacher_logits = teacher(
-                    input_ids=batch['syn_input_ids'],
-                ).logits
-                syn_student_logits = student(
-                    input_ids=batch['syn_input_ids'],
-                ).logits
+            for i, batch in timer.batches(steps.epoch_batches(train_dataloader, epoch)):
+                with timer.phase('h2d'):
+                    batch = {k : batch[k].to(self.device) for k in batch}
+                with steps.accumulate(student):
+                    with self.autocast():
+                        if args.fuse_student_forward:
+                            # real and synthetic rows in one batch, the collator padded both to the same length
+                            batch_size = batch['input_ids'].shape[0]
+                            input_ids = torch.cat([batch['input_ids'], batch['syn_input_ids']], dim=0)
+                            attention_mask = torch.cat([batch['attention_mask'], batch['syn_attention_mask']], dim=0)
+                            with timer.phase('teacher_forward'):
+                                if teacher_cache is not None:
+                                    real_teacher_logits, syn_teacher_logits = teacher_cache.lookup(batch['idx'], self.device)
+                                else:
+                                    teacher_logits = teacher(input_ids=input_ids, attention_mask=attention_mask).logits
+                                    real_teacher_logits, syn_teacher_logits = teacher_logits.split(batch_size)
+                            with timer.phase('student_forward'):
+                                student_logits = student(input_ids=input_ids, attention_mask=attention_mask).logits
+                            real_student_logits, syn_student_logits = student_logits.split(batch_size)
+                            ce_loss = F.cross_entropy(real_student_logits, batch['labels'].reshape(-1))
+                        else:
+                            # the teacher cache lookup is counted as teacher forward
+                            with timer.phase('teacher_forward'):
+                                if teacher_cache is not None:
+                                    real_teacher_logits, syn_teacher_logits = teacher_cache.lookup(batch['idx'], self.device)
+                                else:
+                                    real_teacher_logits = teacher(
+                                        input_ids=batch['input_ids'],
+                                        attention_mask=batch['attention_mask'],
+                                    ).logits
+                                    syn_teacher_logits = teacher(
+                                        input_ids=batch['syn_input_ids'],
+                                        attention_mask=batch['syn_attention_mask'],
+                                    ).logits
+
+                            with timer.phase('student_forward'):
+                                # few-shot dataset
+                                real_student_output = student(
+                                    input_ids=batch['input_ids'],
+                                    attention_mask=batch['attention_mask'],
+                                    labels=batch['labels'],
+                                )
+                        
+                                # syn_data training
+                                syn_student_logits = student(
+                                    input_ids=batch['syn_input_ids'],
+                                    attention_mask=batch['syn_attention_mask'],
+                                ).logits
+                    
+                            real_student_logits = real_student_output.logits
+                            ce_loss = real_student_output.loss
                 
-                real_student_logits = real_student_output.logits
                 
-                real_t_pred = F.log_softmax(real_teacher_logits, dim=1)
-                real_s_pred = F.log_softmax(real_student_logits, dim=1)
+                    real_t_pred = F.log_softmax(real_teacher_logits.float(), dim=1)
+                    real_s_pred = F.log_softmax(real_student_logits.float(), dim=1)
                 
-                syn_t_pred = F.log_softmax(syn_teacher_logits, dim=1)
-                syn_s_pred = F.log_softmax(syn_student_logits, dim=1)
+                    syn_t_pred = F.log_softmax(syn_teacher_logits.float(), dim=1)
+                    syn_s_pred = F.log_softmax(syn_student_logits.float(), dim=1)
                 
-                loss = F.kl_div(real_s_pred, real_t_pred, reduction='batchmean', log_target=True) + F.kl_div(syn_s_pred, syn_t_pred, reduction='batchmean', log_target=True)
-                # print(F.kl_div(real_s_pred, real_t_pred, reduction='batchmean', log_target=True).item(), 
-                #      F.kl_div(syn_s_pred, syn_t_pred, reduction='batchmean', log_target=True).item(),
-                #      real_student_output.loss.item()) 
-                loss = (loss + real_student_output.loss) / 3
-                logger.info(f"loss : {loss.item()}")
-                loss.backward()
-                s_optimizer.step()
-                s_optimizer.zero_grad()
-
-            # eval on student
+                    loss = F.kl_div(real_s_pred, real_t_pred, reduction='batchmean', log_target=True) + F.kl_div(syn_s_pred, syn_t_pred, reduction='batchmean', log_target=True)
+                    # print(F.kl_div(real_s_pred, real_t_pred, reduction='batchmean', log_target=True).item(), 
+                    #      F.kl_div(syn_s_pred, syn_t_pred, reduction='batchmean', log_target=True).item(),
+                    #      real_student_output.loss.item()) 
+                    loss = (loss + ce_loss) / 3
+                    with timer.phase('backward'):
+                        self.accelerator.backward(loss)
+                    with timer.phase('optimizer'):
+                        stepped = steps.step()
+                if stepped:
+                    # no `.item()` here, the logger thread reads the loss
+                    self.sample_logger.log_metrics('student', steps.completed_steps, loss=loss, ce_loss=ce_loss)
+                with timer.phase('checkpoint'):
+                    steps.maybe_save_checkpoint(epoch, i, stepped=stepped)
+                meter.update(batch['attention_mask'], batch['syn_attention_mask'])
+                if steps.done:
+                    break
+
+            # eval on student, timed outside of the steps
             if epoch % 10 == 0:
                 student.eval()
-                eval_metric = self.eval_on_clf(student)
-                logger.info(f'test results: {eval_metric}')
\ No newline at end of file
+                timer.end_step()
+                with timer.phase('eval'):
+                    eval_metric = self.eval_on_clf(student)
+                logger.info(f'test results: {eval_metric}')
+            if steps.done:
+                break
+            steps.maybe_save_checkpoint(epoch, end_of_epoch=True)
+        self.record_throughput(meter, timer)
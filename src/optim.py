@@ -0,0 +1,195 @@
+import json
+import math
+import os
+
+import torch
+from accelerate import skip_first_batches
+from accelerate.logging import get_logger
+from tqdm.auto import tqdm
+
+logger = get_logger(__name__)
+
+
+class TrainingSteps:
+    """
+    Gradient accumulation and optimizer steps shared by the training stages.
+
+    Every micro batch runs under `accelerator.accumulate`, which skips the DDP all-reduce (`no_sync`) until the
+    last micro batch of an update. The prepared optimizer then only steps every `gradient_accumulation_steps` micro
+    batches and at the end of an epoch; `accelerator.backward` scales the loss accordingly. Training stops after
+    `max_train_steps` optimizer steps.
+
+    With `checkpointing_steps` the stage is checkpointed every n optimizer steps (or every epoch with `"epoch"`) to
+    `checkpoint_dir/step_{n}`: `accelerator.save_state` (prepared models, optimizers, RNG states), the weights of
+    `extra_models` that are not prepared, and the epoch and number of batches consumed in it. `resume` loads one
+    and `epoch_batches` skips the batches it already consumed.
+
+    Args:
+        accelerator (`Accelerator`): created with the `gradient_accumulation_steps` to use.
+        optimizer (`AcceleratedOptimizer`): the prepared optimizer of the stage.
+        num_batches (`int`): micro batches per epoch on this process.
+        num_train_epochs (`int`): epochs to train, unless `max_train_steps` is given.
+        max_train_steps (`int`, *optional*): total optimizer steps, overrides `num_train_epochs`.
+        checkpoint_dir (`str`, *optional*): directory of this stage's checkpoints.
+        checkpointing_steps (`str`, *optional*): an integer number of optimizer steps, or `"epoch"`.
+        extra_models (`dict`, *optional*): models trained by the stage but not prepared, by name.
+    """
+
+    def __init__(
+        self,
+        accelerator,
+        optimizer,
+        num_batches,
+        num_train_epochs,
+        max_train_steps=None,
+        checkpoint_dir=None,
+        checkpointing_steps=None,
+        extra_models=None,
+    ):
+        self.accelerator = accelerator
+        self.optimizer = optimizer
+        self.gradient_accumulation_steps = accelerator.gradient_accumulation_steps
+        self.num_update_steps_per_epoch = math.ceil(num_batches / self.gradient_accumulation_steps)
+        if max_train_steps is None:
+            max_train_steps = num_train_epochs * self.num_update_steps_per_epoch
+        self.max_train_steps = max_train_steps
+        self.num_train_epochs = math.ceil(max_train_steps / self.num_update_steps_per_epoch)
+        self.completed_steps = 0
+        self.progress_bar = None
+
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpointing_steps = checkpointing_steps
+        if checkpointing_steps is not None and checkpointing_steps != 'epoch':
+            self.checkpointing_steps = int(checkpointing_steps)
+        self.extra_models = extra_models or {}
+        self.starting_epoch = 0
+        self.resume_step = 0
+
+    def log_plan(self, name, per_device_batch_size):
+        total_batch_size = per_device_batch_size * self.accelerator.num_processes * self.gradient_accumulation_steps
+        logger.info(f"***** Running {name} training *****")
+        logger.info(f"  Num Epochs = {self.num_train_epochs}")
+        logger.info(f"  Instantaneous batch size per device = {per_device_batch_size}")
+        logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
+        logger.info(f"  Gradient Accumulation steps = {self.gradient_accumulation_steps}")
+        logger.info(f"  Total optimization steps = {self.max_train_steps}")
+        logger.info(f"  num_update_steps_per_epoch = {self.num_update_steps_per_epoch}")
+        self.progress_bar = tqdm(range(self.max_train_steps), disable=not self.accelerator.is_local_main_process)
+
+    def accumulate(self, *models):
+        return self.accelerator.accumulate(*models)
+
+    @property
+    def sync_gradients(self):
+        """Whether the current micro batch ends an update, i.e. its backward all-reduces the gradients."""
+        return self.accelerator.sync_gradients
+
+    def step(self):
+        """Call after the backward of every micro batch, steps the optimizer once the update is complete."""
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+        if not self.accelerator.sync_gradients:
+            return False
+        self.completed_steps += 1
+        if self.progress_bar is not None:
+            self.progress_bar.update(1)
+        return True
+
+    @property
+    def done(self):
+        return self.completed_steps >= self.max_train_steps
+
+    def epochs(self):
+        return range(self.starting_epoch, self.num_train_epochs)
+
+    def epoch_batches(self, dataloader, epoch):
+        """(index in the epoch, batch) pairs, without the batches consumed before the checkpoint we resumed from."""
+        # the batch order of an epoch (`--group_by_length`) is seeded by the epoch, also in a resumed run
+        dataloader.set_epoch(epoch)
+        if epoch == self.starting_epoch and self.resume_step > 0:
+            return enumerate(skip_first_batches(dataloader, self.resume_step), start=self.resume_step)
+        return enumerate(dataloader)
+
+    def maybe_save_checkpoint(self, epoch, step=None, stepped=False, end_of_epoch=False):
+        """
+        Called after every micro batch with its index `step` in the epoch and `stepped` as returned by `step()`,
+        and with `end_of_epoch` once the epoch is over.
+        """
+        if self.checkpointing_steps is None or self.checkpoint_dir is None:
+            return
+        if self.checkpointing_steps == 'epoch':
+            if end_of_epoch:
+                self.save_checkpoint(f"epoch_{epoch}", epoch=epoch + 1, step=0)
+        elif stepped and self.completed_steps % self.checkpointing_steps == 0:
+            self.save_checkpoint(f"step_{self.completed_steps}", epoch=epoch, step=step + 1)
+
+    def save_checkpoint(self, name, epoch, step):
+        output_dir = os.path.join(self.checkpoint_dir, name)
+        accelerator = self.accelerator
+        accelerator.save_state(output_dir)
+        if accelerator.is_main_process:
+            for model_name, model in self.extra_models.items():
+                torch.save(model.state_dict(), os.path.join(output_dir, f"{model_name}.bin"))
+            state = {'epoch': epoch, 'step': step, 'completed_steps': self.completed_steps}
+            with open(os.path.join(output_dir, TRAINING_STATE_NAME), 'w') as f:
+                json.dump(state, f)
+        accelerator.wait_for_everyone()
+        logger.info(f"saved checkpoint {output_dir}")
+
+    def resume(self, resume_from_checkpoint):
+        """
+        Load `resume_from_checkpoint`, a checkpoint directory of this stage or `"latest"` for the newest one in
+        `checkpoint_dir`. Returns whether a checkpoint was loaded.
+        """
+        if not resume_from_checkpoint:
+            return False
+        if resume_from_checkpoint == 'latest':
+            input_dir = latest_checkpoint(self.checkpoint_dir)
+            if input_dir is None:
+                return False
+        else:
+            input_dir = resume_from_checkpoint
+            if not is_checkpoint_of(input_dir, self.checkpoint_dir):
+                logger.info(f"{input_dir} is not a checkpoint of this stage ({self.checkpoint_dir}), starting from scratch")
+                return False
+
+        self.accelerator.load_state(input_dir)
+        for model_name, model in self.extra_models.items():
+            model.load_state_dict(torch.load(os.path.join(input_dir, f"{model_name}.bin"), map_location='cpu'))
+        with open(os.path.join(input_dir, TRAINING_STATE_NAME)) as f:
+            state = json.load(f)
+        self.completed_steps = state['completed_steps']
+        self.starting_epoch = state['epoch']
+        self.resume_step = state['step']
+        if self.progress_bar is not None:
+            self.progress_bar.update(self.completed_steps)
+        logger.info(
+            f"resumed from {input_dir}: epoch {self.starting_epoch}, {self.resume_step} batches into it, "
+            f"{self.completed_steps} optimizer steps done"
+        )
+        return True
+
+
+TRAINING_STATE_NAME = 'training_state.json'
+
+
+def is_checkpoint_of(checkpoint, checkpoint_dir):
+    """Whether `checkpoint` is in `checkpoint_dir`, relative and absolute paths or symlinks alike."""
+    if checkpoint_dir is None:
+        return False
+    return os.path.dirname(os.path.realpath(checkpoint)) == os.path.realpath(checkpoint_dir)
+
+
+def latest_checkpoint(checkpoint_dir):
+    """The checkpoint in `checkpoint_dir` with the most optimizer steps, `None` if there is none."""
+    if checkpoint_dir is None or not os.path.isdir(checkpoint_dir):
+        return None
+    checkpoints = []
+    for name in os.listdir(checkpoint_dir):
+        state_path = os.path.join(checkpoint_dir, name, TRAINING_STATE_NAME)
+        if os.path.isfile(state_path):
+            with open(state_path) as f:
+                checkpoints.append((json.load(f)['completed_steps'], name))
+    if not checkpoints:
+        return None
+    return os.path.join(checkpoint_dir, max(checkpoints)[1])
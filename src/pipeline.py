@@ -0,0 +1,190 @@
+import glob
+import hashlib
+import json
+import os
+
+from accelerate.logging import get_logger
+
+from src.dataset import file_fingerprint, local_glue_fingerprint
+from src.synthetic import synthetic_data_paths
+
+logger = get_logger(__name__)
+
+# settings shared by every stage that reads the GLUE data and trains
+DATA_ARGS = [
+    'task_name', 'max_length', 'pad_to_max_length', 'return_special_tokens_mask', 'select_k_per_class',
+    'mlm_probability', 'batch_size', 'group_by_length', 'seed',
+]
+TRAIN_ARGS = ['gradient_accumulation_steps', 'max_train_steps', 'weight_decay', 'precision']
+TEACHER_INFERENCE_ARGS = ['teacher_dtype', 'quantize_teacher', 'quantize_teacher_max_metric_drop']
+
+# args each stage's output depends on, besides its upstream artifacts
+STAGE_ARGS = {
+    'teacher': DATA_ARGS + TRAIN_ARGS + ['teacher_lr', 'teacher_num_train_epochs'],
+    'generator': DATA_ARGS + TRAIN_ARGS + TEACHER_INFERENCE_ARGS + ['generator_lr', 'generator_num_train_epochs'],
+    'generate': DATA_ARGS + [
+        'precision', 'syn_data_path', 'syn_data_format', 'save_syn_text', 'syn_source', 'syn_generation_rounds',
+        'num_samples_per_input', 'resample_mask_probability',
+    ],
+    'student': DATA_ARGS + TRAIN_ARGS + TEACHER_INFERENCE_ARGS + [
+        'student_lr', 'student_num_train_epochs', 'syn_data_format', 'fuse_student_forward', 'cache_teacher_logits',
+    ],
+}
+# upstream models and artifacts of each stage
+STAGE_INPUTS = {
+    'teacher': ['teacher'],
+    'generator': ['teacher', 'generator', 'student'],
+    'generate': ['generator'],
+    'student': ['teacher', 'student', 'generate'],
+}
+
+
+def hash_paths(paths):
+    """Content hash of the files under `paths`, `None` if one of them does not exist."""
+    hasher = hashlib.sha1()
+    for relative_path, path in _list_files(paths):
+        hasher.update(relative_path.encode())
+        hasher.update(file_fingerprint(path).encode())
+    return hasher.hexdigest() if all(os.path.exists(path) for path in paths) else None
+
+
+def stat_paths(paths):
+    """Cheap signature of the files under `paths` (sizes and modification times) to notice changed artifacts."""
+    return [[relative_path, os.path.getsize(path), os.stat(path).st_mtime_ns] for relative_path, path in _list_files(paths)]
+
+
+def _list_files(paths):
+    files = []
+    for root in paths:
+        if os.path.isfile(root):
+            files.append((os.path.basename(root), root))
+            continue
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files.append((os.path.relpath(path, os.path.dirname(root)), path))
+    return sorted(files)
+
+
+class Pipeline:
+    """
+    Runs the CILDA stages and skips the ones whose output is already up to date.
+
+    The fingerprint of a stage hashes the args its output depends on (`STAGE_ARGS`), the GLUE data, the number of
+    processes and the identity of its inputs (`STAGE_INPUTS`): the artifact hash of an upstream stage, the content
+    hash of a `--*_checkpoint_path` or the name of a pretrained model. A stage whose `--*_checkpoint_path` is its own
+    artifact counts as starting from the pretrained model. After a stage runs, its fingerprint and a hash
+    of its artifact are written to `output_dir/pipeline_manifest.json`. With `--skip_up_to_date_stages` a stage is
+    skipped when the manifest has its fingerprint and the artifact on disk is unchanged; a skipped teacher or
+    generator is then loaded from its artifact by the later stages.
+
+    Args:
+        args (`argparse.Namespace`): the parsed arguments, updated with the checkpoint paths of skipped stages.
+        accelerator (`Accelerator`): only the main process writes the manifest.
+    """
+
+    def __init__(self, args, accelerator):
+        self.args = args
+        self.accelerator = accelerator
+        self.manifest_path = None
+        if args.output_dir is not None:
+            self.manifest_path = os.path.join(args.output_dir, 'pipeline_manifest.json')
+        self.manifest = {}
+        if self.manifest_path is not None and os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        # identity of every model / artifact produced or reused in this run
+        self.identities = {}
+        self._data_fingerprint = None
+
+    def artifacts(self, stage):
+        args = self.args
+        if stage in ['teacher', 'generator']:
+            return [os.path.join(args.output_dir, stage)]
+        if stage == 'generate':
+            ids_path, text_path = synthetic_data_paths(os.path.join('data', args.syn_data_path))
+            # the text of process 0 and of the other processes, see `rank_paths`
+            text_paths = [text_path] + sorted(glob.glob(os.path.splitext(text_path)[0] + '.rank-*.json'))
+            return [ids_path] + [path for path in text_paths if os.path.isfile(path)]
+        # the student is not saved
+        return []
+
+    def data_fingerprint(self):
+        if self._data_fingerprint is None:
+            data_dir = self.args.glue_data_dir
+            self._data_fingerprint = 'glue' if data_dir is None else local_glue_fingerprint(data_dir)
+        return self._data_fingerprint
+
+    def identity(self, name, stage=None):
+        """Identity of the model or artifact `name` as an input of `stage`."""
+        if name in self.identities:
+            return self.identities[name]
+        args = self.args
+        if name == 'generate':
+            identity = hash_paths(self.artifacts('generate'))
+        else:
+            checkpoint_path = getattr(args, f"{name}_checkpoint_path", None)
+            if checkpoint_path is not None and name == stage and self.is_artifact(stage, checkpoint_path):
+                # a stage continuing from its own previous output: that is not an upstream input, or every run
+                # would change the fingerprint of the next one and the stage would never be skipped
+                return f"pretrained:{getattr(args, f'{name}_model_name')}"
+            if checkpoint_path is not None:
+                identity = hash_paths([checkpoint_path])
+            else:
+                identity = f"pretrained:{getattr(args, f'{name}_model_name')}"
+        self.identities[name] = identity
+        return identity
+
+    def is_artifact(self, stage, path):
+        return os.path.realpath(path) in [os.path.realpath(artifact) for artifact in self.artifacts(stage)]
+
+    def fingerprint(self, stage):
+        args = self.args
+        inputs = {
+            'args': {key: getattr(args, key) for key in STAGE_ARGS[stage]},
+            'data': self.data_fingerprint(),
+            'num_processes': self.accelerator.num_processes,
+            'inputs': {name: self.identity(name, stage) for name in STAGE_INPUTS[stage]},
+        }
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_up_to_date(self, stage, fingerprint):
+        entry = self.manifest.get(stage)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+        artifacts = self.artifacts(stage)
+        if not all(os.path.exists(path) for path in artifacts):
+            return False
+        return stat_paths(artifacts) == entry['artifact_stat']
+
+    def run(self, stage, fn):
+        """Run `fn` for `stage`, unless it is up to date and `--skip_up_to_date_stages` is set."""
+        fingerprint = self.fingerprint(stage)
+        if self.args.skip_up_to_date_stages and self.is_up_to_date(stage, fingerprint):
+            logger.info(f"skipping {stage} stage, its output is up to date ({fingerprint[:12]})")
+            self.identities[stage] = self.manifest[stage]['artifact_hash']
+            if stage in ['teacher', 'generator']:
+                # later stages load the model from the artifact
+                setattr(self.args, f"{stage}_checkpoint_path", self.artifacts(stage)[0])
+            return False
+
+        fn()
+        artifacts = self.artifacts(stage)
+        artifact_hash = hash_paths(artifacts) if artifacts else None
+        self.identities[stage] = artifact_hash
+        self.manifest[stage] = {
+            'fingerprint': fingerprint,
+            'artifact_hash': artifact_hash,
+            'artifact_stat': stat_paths(artifacts),
+        }
+        self.write_manifest()
+        return True
+
+    def write_manifest(self):
+        self.accelerator.wait_for_everyone()
+        if self.manifest_path is None or not self.accelerator.is_main_process:
+            return
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
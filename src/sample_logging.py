@@ -0,0 +1,127 @@
+import copy
+import queue
+import threading
+import time
+
+import torch
+from accelerate.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class SampleLogger:
+    """
+    Sampled, rate limited logging of text samples and scalar metrics from the training loops.
+
+    A call only records something every `samples_every` / `metrics_every` steps and while the rate limit allows it,
+    otherwise it returns right away. A recorded sample is a copy of the token ids and a metric the detached tensor,
+    both put on a queue: a background thread decodes the ids, reads the tensors (the `.item()` sync happens there)
+    and writes the log lines. Records over the rate limit or beyond a full queue are dropped and counted.
+
+    Args:
+        tokenizer (`PreTrainedTokenizerBase`): decodes the samples, the thread uses its own copy.
+        samples_every (`int`, *optional*, defaults to 0): steps between logged samples, 0 disables them.
+        metrics_every (`int`, *optional*, defaults to 0): steps between logged metrics, 0 disables them.
+        max_records_per_second (`float`, *optional*, defaults to 10.0): rate limit over all records, 0 for none.
+        max_queue_size (`int`, *optional*, defaults to 1000): records waiting for the thread.
+        enabled (`bool`, *optional*, defaults to `True`): e.g. only on the main process.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        samples_every=0,
+        metrics_every=0,
+        max_records_per_second=10.0,
+        max_queue_size=1000,
+        enabled=True,
+    ):
+        self.tokenizer = tokenizer
+        self.samples_every = samples_every
+        self.metrics_every = metrics_every
+        self.max_records_per_second = max_records_per_second
+        self.enabled = enabled
+        self.dropped = 0
+
+        # token bucket of the rate limit, allows a burst of one second worth of records
+        self.capacity = max(max_records_per_second, 1.0)
+        self.budget = self.capacity
+        self.last_refill = time.monotonic()
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = None
+
+    def log_samples(self, stage, step, **token_ids):
+        """Log the decoded `token_ids` (name -> 1d ids) of `step`, if it is sampled."""
+        if not self._sampled(step, self.samples_every):
+            return False
+        # copied, so later in place updates of the batch do not show up in the log
+        return self._put(('samples', stage, step, {name: ids.detach().clone() for name, ids in token_ids.items()}))
+
+    def log_metrics(self, stage, step, **metrics):
+        """Log the scalar `metrics` (name -> float or 0d tensor) of `step`, if it is sampled."""
+        if not self._sampled(step, self.metrics_every):
+            return False
+        metrics = {name: value.detach() if torch.is_tensor(value) else value for name, value in metrics.items()}
+        return self._put(('metrics', stage, step, metrics))
+
+    def _sampled(self, step, every):
+        return self.enabled and bool(every) and step % every == 0
+
+    def _put(self, record):
+        if not self._take_budget():
+            self.dropped += 1
+            return False
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, args=(copy.deepcopy(self.tokenizer),), daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait((record, self.dropped))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.dropped = 0
+        return True
+
+    def _take_budget(self):
+        if not self.max_records_per_second:
+            return True
+        now = time.monotonic()
+        self.budget = min(self.capacity, self.budget + (now - self.last_refill) * self.max_records_per_second)
+        self.last_refill = now
+        if self.budget < 1:
+            return False
+        self.budget -= 1
+        return True
+
+    def _run(self, tokenizer):
+        # fast tokenizers are not safe to share between threads, hence the copy
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                (kind, stage, step, values), dropped = item
+                if dropped:
+                    logger.info(f"{dropped} log records dropped by sampling rate limit")
+                if kind == 'samples':
+                    for name, ids in values.items():
+                        logger.info(f"{stage} step {step} {name}: {tokenizer.decode(ids.cpu(), skip_special_tokens=True)}")
+                else:
+                    metrics = ", ".join(
+                        f"{name} {value.item() if torch.is_tensor(value) else value:.4f}" for name, value in values.items()
+                    )
+                    logger.info(f"{stage} step {step}: {metrics}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until everything recorded so far is logged."""
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,50 @@
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+
+class GumbelSampler(nn.Module):
+    """
+    Hard Gumbel-softmax sampler shared by generator training and synthetic data generation.
+
+    `F.gumbel_softmax(hard=True)` followed by `sum(one_hot * arange(vocab))` recovers the token id, but it needs a
+    (batch, seq_len, vocab) index tensor that also takes part in backward. Here the id is the argmax of the perturbed
+    logits and the straight-through estimate is `y_soft @ arange(vocab)`, which has the same forward value and the
+    same gradient w.r.t. the soft sample while only keeping a (vocab,) index vector around.
+
+    Args:
+        tau (`float`, *optional*, defaults to 1.0):
+            Gumbel-softmax temperature.
+    """
+
+    def __init__(self, tau: float = 1.0):
+        super().__init__()
+        self.tau = tau
+        self._vocab_index = None
+
+    def vocab_index(self, logits):
+        vocab_size = logits.shape[-1]
+        index = self._vocab_index
+        if index is None or index.shape[0] != vocab_size or index.device != logits.device or index.dtype != logits.dtype:
+            index = torch.arange(vocab_size, dtype=logits.dtype, device=logits.device)
+            self._vocab_index = index
+        return index
+
+    def forward(self, logits: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Returns:
+            `input_ids` (`torch.LongTensor`) with the sampled token ids, and the same ids as a float tensor carrying
+            straight-through gradients to `logits` (`None` when autograd is not recording).
+        """
+        gumbels = -torch.empty_like(logits, memory_format=torch.legacy_contiguous_format).exponential_().log()
+        perturbed = (logits + gumbels) / self.tau
+        input_ids = perturbed.argmax(dim=-1)
+        if not (torch.is_grad_enabled() and logits.requires_grad):
+            return input_ids, None
+
+        # straight-through: forward value is `input_ids`, backward is the one of sum(y_soft * arange(vocab))
+        y_soft = perturbed.softmax(dim=-1)
+        expected_ids = torch.matmul(y_soft, self.vocab_index(logits))
+        st_ids = input_ids.to(expected_ids.dtype) + (expected_ids - expected_ids.detach())
+        return input_ids, st_ids
@@ -0,0 +1,168 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from datasets import Dataset, concatenate_datasets, load_from_disk
+
+from src.dataset import save_to_cache
+
+
+def synthetic_data_paths(syn_data_path):
+    """
+    Locations of the synthetic data for `syn_data_path` (e.g. `data/syn_data.json`): the token id shard
+    directory (`data/syn_data`) and the text json (`data/syn_data.json`).
+    """
+    root, _ = os.path.splitext(syn_data_path)
+    return root, root + '.json'
+
+
+def rank_paths(ids_path, text_path, process_index):
+    """
+    Shard directory and text file written by process `process_index` of a generation run, every process writes its
+    own so they never touch each other's files. Process 0 keeps the plain text file name.
+    """
+    rank = f'rank-{process_index:05d}'
+    if process_index > 0:
+        text_path = f"{os.path.splitext(text_path)[0]}.{rank}.json"
+    return os.path.join(ids_path, rank), text_path
+
+
+def completed_rank_paths(ids_path, text_path):
+    """`rank_paths` of every process of the last generation run, which must have finished."""
+    manifest = read_manifest(os.path.join(ids_path, 'rank-00000'))
+    if manifest is None:
+        raise FileNotFoundError(f"No synthetic data in {ids_path}, run with `--generate_data` first.")
+    paths = [rank_paths(ids_path, text_path, i) for i in range(manifest['settings']['num_processes'])]
+    for rank_ids_path, _ in paths:
+        manifest = read_manifest(rank_ids_path)
+        if manifest is None or not manifest['complete']:
+            raise ValueError(
+                f"Synthetic data generation into {rank_ids_path} did not finish, rerun `--generate_data` to resume it."
+            )
+    return paths
+
+
+def strip_padding(input_ids, attention_mask):
+    return [ids[mask].tolist() for ids, mask in zip(input_ids.cpu(), attention_mask.cpu().bool())]
+
+
+def read_manifest(path):
+    manifest_path = os.path.join(path, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+class SyntheticShardWriter:
+    """
+    Streams generated (real, synthetic) pairs to disk in shards of `shard_size` rows. With several processes each
+    one has its own writer on its own `rank_paths`.
+
+    Each shard is an Arrow dataset of unpadded `input_ids`, `syn_input_ids`, `attention_mask` and `label` under
+    `path`; the synthetic ids only differ from the real ones at masked positions, so both share `attention_mask`.
+    Decoded text can be appended to `text_path` as json lines. After every shard `manifest.json` records how many
+    dataloader batches are already on disk, so an interrupted run with the same `settings` resumes after the last
+    completed shard while a finished or differently configured run is started over.
+
+    Args:
+        path (`str`): shard directory.
+        shard_size (`int`): number of rows buffered in host memory before a shard is written.
+        settings (`dict`): generation settings, a run is only resumed if they match.
+        tokenizer (*optional*): used to decode the text sidecar.
+        write_ids (`bool`): write the token id shards.
+        text_path (`str`, *optional*): json lines file for the decoded text.
+    """
+
+    def __init__(self, path, shard_size, settings, tokenizer=None, write_ids=True, text_path=None):
+        self.path = path
+        self.shard_size = shard_size
+        self.tokenizer = tokenizer
+        self.write_ids = write_ids
+        self.text_path = text_path
+
+        manifest = read_manifest(path)
+        if manifest is None or manifest['complete'] or manifest['settings'] != settings:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            manifest = {'settings': settings, 'shards': [], 'num_rows': 0, 'batches_done': 0, 'text_bytes': 0, 'complete': False}
+            if text_path is not None:
+                open(text_path, 'w').close()
+        elif text_path is not None:
+            # drop text written after the last completed shard
+            with open(text_path, 'a') as f:
+                f.truncate(manifest['text_bytes'])
+        self.manifest = manifest
+        self.pending_batches = 0
+        self.buffer = {'input_ids': [], 'syn_input_ids': [], 'attention_mask': [], 'label': []}
+
+    @property
+    def batches_done(self):
+        return self.manifest['batches_done']
+
+    @property
+    def num_rows(self):
+        return self.manifest['num_rows'] + len(self.buffer['label'])
+
+    def write_batch(self, input_ids, syn_input_ids, attention_mask, labels):
+        self.buffer['input_ids'].extend(strip_padding(input_ids, attention_mask))
+        self.buffer['syn_input_ids'].extend(strip_padding(syn_input_ids, attention_mask))
+        self.buffer['attention_mask'].extend([[1] * length for length in attention_mask.sum(dim=1).tolist()])
+        self.buffer['label'].extend(labels.reshape(-1).tolist())
+        self.pending_batches += 1
+        if len(self.buffer['label']) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer['label']:
+            return
+        manifest = self.manifest
+        if self.write_ids:
+            name = f"shard-{len(manifest['shards']):05d}"
+            save_to_cache(Dataset.from_dict(self.buffer), os.path.join(self.path, name))
+            manifest['shards'].append(name)
+        if self.text_path is not None:
+            self.write_text()
+            manifest['text_bytes'] = os.path.getsize(self.text_path)
+        manifest['num_rows'] += len(self.buffer['label'])
+        manifest['batches_done'] += self.pending_batches
+        self.write_manifest()
+
+        self.pending_batches = 0
+        self.buffer = {key: [] for key in self.buffer}
+
+    def write_text(self):
+        real_text = self.tokenizer.batch_decode(self.buffer['input_ids'], skip_special_tokens=True)
+        synthetic_text = self.tokenizer.batch_decode(self.buffer['syn_input_ids'], skip_special_tokens=True)
+        with open(self.text_path, 'a') as f:
+            for text, syn_text, label in zip(real_text, synthetic_text, self.buffer['label']):
+                f.write(json.dumps({"ori_text": text, "syn_text": syn_text, "label": [label]}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_manifest(self):
+        manifest_path = os.path.join(self.path, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def close(self):
+        self.flush()
+        self.manifest['complete'] = True
+        self.write_manifest()
+
+
+def load_synthetic_ids(paths):
+    """
+    Load the shards written by the `SyntheticShardWriter`s in `paths`, with `labels` and a row index `idx` for the
+    student loader.
+    """
+    shards = [os.path.join(path, name) for path in paths for name in read_manifest(path)['shards']]
+    if not shards:
+        raise FileNotFoundError(
+            f"No synthetic data shards in {os.path.dirname(paths[0])}, run `--generate_data` with `--syn_data_format ids` first."
+        )
+    dataset = concatenate_datasets([load_from_disk(shard) for shard in shards])
+    dataset = dataset.rename_column('label', 'labels')
+    return dataset.add_column('idx', np.arange(len(dataset)))
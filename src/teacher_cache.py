@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+from accelerate.logging import get_logger
+from tqdm.auto import tqdm
+
+logger = get_logger(__name__)
+
+
+def model_fingerprint(model):
+    """Hash of the model config and weights, so a retrained teacher never reuses stale soft labels."""
+    hasher = hashlib.sha1(model.config.to_json_string().encode())
+    for name, tensor in model.state_dict().items():
+        hasher.update(name.encode())
+        if not torch.is_tensor(tensor):
+            # e.g. the dtype entry of dynamically quantized linear layers
+            hasher.update(repr(tensor).encode())
+            continue
+        if tensor.is_quantized:
+            tensor = tensor.dequantize()
+        hasher.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()
+
+
+class TeacherLogitCache:
+    """
+    Teacher logits for the real and the synthetic inputs of the synthetic dataset, computed once per
+    (teacher weights, dataset fingerprint) and kept as a memory-mapped `.npy` file of shape (num_examples, 2, num_labels).
+
+    Args:
+        cache_dir (`str`): directory of the synthetic data, the cache file is written next to it.
+        teacher (`AutoModelForSequenceClassification`): the frozen teacher.
+        dataset (`datasets.Dataset`): the processed synthetic dataset, rows are looked up by its `idx` column.
+    """
+
+    def __init__(self, cache_dir, teacher, dataset):
+        self.teacher = teacher
+        self.dataset = dataset
+        key = hashlib.sha1(f"{model_fingerprint(teacher)}-{dataset._fingerprint}".encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, f"teacher_logits-{key}.npy")
+        self.logits = None
+
+    def load(self, dataloader, device):
+        if not os.path.exists(self.path):
+            self.build(dataloader, device)
+        self.logits = np.load(self.path, mmap_mode='r')
+        return self
+
+    @torch.no_grad()
+    def build(self, dataloader, device):
+        logger.info(f"computing teacher logits into {self.path}")
+        teacher = self.teacher
+        teacher.eval()
+        num_labels = teacher.config.num_labels
+        tmp_path = self.path + '.tmp.npy'
+        logits = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(self.dataset), 2, num_labels))
+        for batch in tqdm(dataloader):
+            idx = batch['idx'].numpy()
+            # same calls as the online teacher forwards in `train_student`
+            real_logits = teacher(
+                input_ids=batch['input_ids'].to(device), attention_mask=batch['attention_mask'].to(device)
+            ).logits
+            syn_logits = teacher(
+                input_ids=batch['syn_input_ids'].to(device), attention_mask=batch['syn_attention_mask'].to(device)
+            ).logits
+            logits[idx, 0] = real_logits.float().cpu().numpy()
+            logits[idx, 1] = syn_logits.float().cpu().numpy()
+        logits.flush()
+        del logits
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, idx, device):
+        """Returns the (real, synthetic) teacher logits of the examples `idx`."""
+        rows = torch.from_numpy(self.logits[idx.cpu().numpy()]).to(device)
+        return rows[:, 0], rows[:, 1]